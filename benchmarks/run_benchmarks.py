@@ -0,0 +1,292 @@
+"""
+Offline CPU benchmarks for the DMI services
+
+Runs each service's batch processing code on tiny, randomly initialised
+models of the same architectures as the real ones (see `tiny_models.py`) and
+synthetic inputs, so no network access, downloaded weights or GPU is needed.
+The numbers say nothing about the quality of the output, and absolute speed is
+not that of the real models, but they are comparable between commits on the
+same machine: a change that makes a service's pre-processing, batching or
+post-processing slower shows up here.
+
+For every service and batch size, reports items/sec, median and 95th
+percentile latency per item (the time taken by the batch the item was in),
+model load time (including importing the service), and peak memory (RSS).
+Each combination runs in a separate process, so these are those of a cold
+start. Results are written as JSON:
+
+    python3 run_benchmarks.py --output before.json
+    git checkout my-branch
+    python3 run_benchmarks.py --output after.json --compare before.json
+
+Services of which the dependencies are not installed are skipped.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+import services
+
+# exit code of a benchmark process when the service's dependencies are missing
+EXIT_MISSING_DEPENDENCY = 3
+
+
+def percentile(values, fraction):
+    """
+    Get a percentile, interpolating between the nearest values
+
+    :param list values:  Values
+    :param float fraction:  Percentile, between 0 and 1
+    :return float:  Percentile
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def git_commit():
+    """
+    Get the current commit, and whether there are uncommitted changes
+
+    :return tuple:  Commit hash (or `None` if not in a git repository), and whether the work tree is dirty
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=services.root, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=services.root,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+        return commit, bool(changes)
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+
+def run_one(args):
+    """
+    Build models, or benchmark one service with one batch size, in this process
+
+    The service's folder is put first on `sys.path`, as it is the working
+    directory in the service's Docker image.
+    """
+    benchmark = services.benchmarks[args.service]
+    sys.path.insert(0, str(services.root.joinpath(benchmark.folder)))
+    model_dir = Path(args.model_dir)
+
+    try:
+        import torch
+        if args.build:
+            torch.manual_seed(0)
+            benchmark.build(model_dir)
+            return
+
+        if args.threads:
+            torch.set_num_threads(args.threads)
+
+        start = time.perf_counter()
+        state = benchmark.load(model_dir)
+        load_time = time.perf_counter() - start
+    except ImportError as e:
+        print(f"{type(e).__name__}: {e}", file=sys.stderr)
+        exit(EXIT_MISSING_DEPENDENCY)
+
+    items = benchmark.items(Path(args.work_dir), args.items)
+
+    # warm up, so one-off initialisation is not measured
+    for _ in range(args.warmup):
+        benchmark.run(state, items[:args.batch_size])
+
+    latencies = []
+    start = time.perf_counter()
+    for offset in range(0, len(items), args.batch_size):
+        batch = items[offset:offset + args.batch_size]
+        batch_start = time.perf_counter()
+        benchmark.run(state, batch)
+        latencies.extend([time.perf_counter() - batch_start] * len(batch))
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "service": args.service,
+        "batch_size": args.batch_size,
+        "status": "ok",
+        "items": len(items),
+        "items_per_sec": len(items) / elapsed if elapsed else 0,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "load_time": load_time,
+        "peak_rss_mb": peak_rss_mb(),
+        "threads": torch.get_num_threads(),
+    }
+    Path(args.result).write_text(json.dumps(result))
+
+
+def spawn(args, service, *extra):
+    """
+    Run this script for one service in a new process
+
+    :param args:  Parsed command line arguments
+    :param str service:  Service name
+    :param extra:  Extra command line arguments
+    :return tuple:  Exit code and standard error output
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--run-one", service, "--model-dir", args.model_dir, "--work-dir",
+               args.work_dir, "--items", str(args.items), "--warmup", str(args.warmup), "--threads", str(args.threads),
+               *extra]
+    # no downloads, and no CUDA even if it is available, so numbers are comparable between machines
+    env = {**os.environ, "HF_HUB_OFFLINE": "1", "TRANSFORMERS_OFFLINE": "1", "CUDA_VISIBLE_DEVICES": "",
+           "TOKENIZERS_PARALLELISM": "false"}
+    process = subprocess.run(command, cwd=args.work_dir, env=env, stdout=None if args.verbose else subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, text=True)
+    if args.verbose and process.stderr:
+        print(process.stderr, file=sys.stderr)
+
+    return process.returncode, process.stderr
+
+
+def last_line(text):
+    lines = [line for line in text.strip().split("\n") if line.strip()]
+    return lines[-1] if lines else ""
+
+
+def compare(results, previous):
+    """
+    Print results next to those of a previous run
+
+    :param list results:  Results of this run
+    :param dict previous:  Contents of a previous results file
+    """
+    previous_results = {(result["service"], result["batch_size"]): result for result in previous["results"]
+                        if result["status"] == "ok"}
+
+    print(f"\nCompared to {previous.get('commit') or 'previous run'}{' (dirty)' if previous.get('dirty') else ''}:")
+    print(f"{'service':<24s} {'batch':>5s} {'items/sec':>10s} {'p95 latency':>12s} {'load time':>10s} {'peak RSS':>9s}")
+    for result in results:
+        before = previous_results.get((result["service"], result["batch_size"])) if result["status"] == "ok" else None
+        if not before:
+            continue
+
+        def ratio(key):
+            return f"{result[key] / before[key]:.2f}x" if before[key] else "-"
+
+        print(f"{result['service']:<24s} {result['batch_size']:>5d} {ratio('items_per_sec'):>10s} "
+              f"{ratio('latency_p95'):>12s} {ratio('load_time'):>10s} {ratio('peak_rss_mb'):>9s}")
+
+
+def main():
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--services", help=f"Comma-separated services (options: {', '.join(services.benchmarks)}; default all)",
+                     default=",".join(services.benchmarks))
+    cli.add_argument("--batch-sizes", "-b", help="Comma-separated batch sizes (default 1,4,16)", default="1,4,16")
+    cli.add_argument("--items", "-n", help="Number of items per service and batch size (default 32)", type=int, default=32)
+    cli.add_argument("--warmup", help="Number of batches to run before measuring (default 1)", type=int, default=1)
+    cli.add_argument("--threads", help="Number of torch threads (default: torch's default)", type=int, default=0)
+    cli.add_argument("--output", "-o", help="File to write results to, as JSON (default benchmark-results.json)",
+                     default="benchmark-results.json")
+    cli.add_argument("--compare", "-c", help="Results file of a previous run to compare with", default=None)
+    cli.add_argument("--model-dir", help="Folder to build the tiny models in (default: a temporary folder)", default=None)
+    cli.add_argument("--work-dir", help="Folder for synthetic inputs and output (default: a temporary folder)", default=None)
+    cli.add_argument("--verbose", "-v", help="Show the output of the benchmark processes", action="store_true",
+                     default=False)
+    # used internally, to run one benchmark in its own process
+    cli.add_argument("--run-one", help=argparse.SUPPRESS, default=None)
+    cli.add_argument("--build", help=argparse.SUPPRESS, action="store_true", default=False)
+    cli.add_argument("--batch-size", help=argparse.SUPPRESS, type=int, default=1)
+    cli.add_argument("--result", help=argparse.SUPPRESS, default=None)
+    args = cli.parse_args()
+
+    if args.run_one:
+        args.service = args.run_one
+        return run_one(args)
+
+    unknown = [service for service in args.services.split(",") if service not in services.benchmarks]
+    if unknown:
+        print(f"Unknown service(s): {', '.join(unknown)}")
+        exit(1)
+
+    previous = None
+    if args.compare:
+        try:
+            previous = json.loads(Path(args.compare).read_text())
+        except (OSError, ValueError) as e:
+            print(f"Could not read results to compare with from {args.compare}: {e}")
+            exit(1)
+
+    with tempfile.TemporaryDirectory(prefix="dmi-benchmark-") as temp_dir:
+        args.model_dir = str(Path(args.model_dir or Path(temp_dir, "models")).resolve())
+        args.work_dir = str(Path(args.work_dir or Path(temp_dir, "work")).resolve())
+        Path(args.work_dir).mkdir(parents=True, exist_ok=True)
+
+        results = []
+        for service in args.services.split(","):
+            print(f"Building tiny model(s) for {service}...")
+            returncode, stderr = spawn(args, service, "--build")
+            if returncode:
+                status = "skipped" if returncode == EXIT_MISSING_DEPENDENCY else "failed"
+                print(f"  {status}: {last_line(stderr)}")
+                results.append({"service": service, "status": status, "reason": last_line(stderr)})
+                continue
+
+            for batch_size in [int(batch_size) for batch_size in args.batch_sizes.split(",")]:
+                result_file = Path(args.work_dir, f"{service}-{batch_size}.json")
+                returncode, stderr = spawn(args, service, "--batch-size", str(batch_size), "--result", str(result_file))
+                if returncode:
+                    status = "skipped" if returncode == EXIT_MISSING_DEPENDENCY else "failed"
+                    print(f"  batch size {batch_size}: {status}: {last_line(stderr)}")
+                    results.append({"service": service, "batch_size": batch_size, "status": status,
+                                    "reason": last_line(stderr)})
+                    if status == "skipped":
+                        break
+                    continue
+
+                result = json.loads(result_file.read_text())
+                results.append(result)
+                print(f"  batch size {batch_size}: {result['items_per_sec']:.1f} items/sec, "
+                      f"p50 {result['latency_p50'] * 1000:.0f} ms, p95 {result['latency_p95'] * 1000:.0f} ms, "
+                      f"load {result['load_time']:.1f}s, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    commit, dirty = git_commit()
+    try:
+        import torch
+        torch_version = torch.__version__
+    except ImportError:
+        torch_version = None
+
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "platform": {
+            "python": platform.python_version(),
+            "system": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch_version,
+        },
+        "settings": {"items": args.items, "batch_sizes": args.batch_sizes, "warmup": args.warmup,
+                     "threads": args.threads},
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"\nResults written to {args.output}")
+
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Benchmark definitions, one per service
+
+Each benchmark builds a tiny model, loads it the way the service does, makes
+synthetic input items, and processes a batch of items with the same functions
+the service's main loop uses. Benchmarks are run with the service's folder on
+`sys.path`, so they import its modules (and `dmi_status`) as the service would.
+"""
+import importlib
+import os
+import random
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from pathlib import Path
+
+import tiny_models
+
+root = Path(__file__).resolve().parent.parent
+
+# labels to classify texts and images into
+labels = ["positive", "negative", "neutral", "news", "politics", "sport", "music", "protest", "city", "portrait"]
+
+
+def synthetic_images(path, count, size=256, seed=0):
+    """
+    Write JPEG images of random noise
+
+    Noise does not compress, so decoding takes about as long as for a photo of
+    the same size.
+
+    :param Path path:  Folder to write the images in
+    :param int count:  Number of images
+    :param int size:  Width and height, in pixels
+    :param int seed:  Random seed, so images are the same for every run
+    :return list:  Image files
+    """
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    path.mkdir(parents=True, exist_ok=True)
+    files = []
+    for index in range(count):
+        image_file = path.joinpath(f"{index:05d}.jpeg")
+        if not image_file.exists():
+            Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(image_file, quality=90)
+        files.append(image_file)
+
+    return files
+
+
+class ServiceBenchmark(ABC):
+    """
+    Base class for service benchmarks
+
+    `build` runs once per benchmark run, in its own process; `load` and `run`
+    are measured, each (service, batch size) combination in a fresh process,
+    so that load time and peak memory are those of a cold start.
+    """
+    # service folder, relative to the repository root
+    folder = ""
+
+    @abstractmethod
+    def build(self, model_dir):
+        """
+        Build the tiny model(s) for this service
+
+        :param Path model_dir:  Folder to save models in
+        """
+
+    @abstractmethod
+    def load(self, model_dir):
+        """
+        Import the service and load its model(s)
+
+        :param Path model_dir:  Folder the models were saved in
+        :return:  State to pass to `run`
+        """
+
+    @abstractmethod
+    def items(self, work_dir, count):
+        """
+        Make synthetic input items
+
+        :param Path work_dir:  Folder to write input files in, if needed
+        :param int count:  Number of items
+        :return list:  Items
+        """
+
+    @abstractmethod
+    def run(self, state, batch):
+        """
+        Process a batch of items
+
+        :param state:  State returned by `load`
+        :param list batch:  Items
+        """
+
+
+class ClipBenchmark(ServiceBenchmark):
+    folder = "openai_clip"
+
+    def build(self, model_dir):
+        tiny_models.build_clip(model_dir.joinpath("clip"))
+
+    def load(self, model_dir):
+        import clip
+        clip_interface = importlib.import_module("clip_interface")
+
+        model, preprocess = clip.load(str(model_dir.joinpath("clip", "clip-tiny.pt")), device=clip_interface.device)
+        text_features = clip_interface.encode_classes(model, "clip-tiny", labels)
+        return clip_interface, model, preprocess, text_features
+
+    def items(self, work_dir, count):
+        return synthetic_images(work_dir.joinpath("images"), count)
+
+    def run(self, state, batch):
+        clip_interface, model, preprocess, text_features = state
+        dataset = clip_interface.ImageDataset(batch, preprocess)
+        indexes, images, errors = clip_interface.collate_images([dataset[index] for index in range(len(dataset))])
+        image_features = clip_interface.encode_images(model, images)
+        probabilities = clip_interface.class_probabilities(image_features, text_features)
+        clip_interface.top_labels_batch(labels, probabilities, top_k=5)
+
+
+class ImageClassifierBenchmark(ServiceBenchmark):
+    folder = "image_classifier"
+
+    def build(self, model_dir):
+        tiny_models.build_image_classifier(model_dir.joinpath("image_classifier"))
+
+    def load(self, model_dir):
+        classifier = importlib.import_module("classifier")
+
+        model_name = str(model_dir.joinpath("image_classifier"))
+        for name, settings in classifier.classifiers.items():
+            settings["preprocessor"] = settings["model"] = None
+
+        settings = classifier.classifiers["features"]
+        settings["model_name"] = model_name
+        settings["preprocessor"], settings["model"] = classifier.load_classifier(model_name)
+        return classifier
+
+    def items(self, work_dir, count):
+        return synthetic_images(work_dir.joinpath("images"), count)
+
+    def run(self, classifier, batch):
+        image_objs = dict([classifier.load_image(path) for path in batch])
+        classifier.classify_batch(image_objs, threshold=0.1)
+
+
+class Blip2Benchmark(ServiceBenchmark):
+    folder = "blip2"
+    max_new_tokens = 10
+    dtype = "float32"
+    # answered with `answer_prompts` if set, otherwise images are captioned
+    prompts = None
+
+    def build(self, model_dir):
+        tiny_models.build_blip2(model_dir.joinpath("blip2"))
+
+    def load(self, model_dir):
+        interface = importlib.import_module("interface")
+
+        processor, model, input_dtype = interface.load_model(str(model_dir.joinpath("blip2")), self.dtype)
+        return interface, processor, model, input_dtype
+
+    def items(self, work_dir, count):
+        return synthetic_images(work_dir.joinpath("images"), count)
+
+    def run(self, state, batch):
+        interface, processor, model, input_dtype = state
+        image_objs = [interface.open_image(path) for path in batch]
+        if self.prompts:
+            interface.answer_prompts(processor, model, image_objs, self.prompts, max_new_tokens=self.max_new_tokens,
+                                     input_dtype=input_dtype)
+        else:
+            interface.caption_batch(processor, model, image_objs, max_new_tokens=self.max_new_tokens,
+                                    input_dtype=input_dtype)
+
+
+class Blip2PromptsFloat16Benchmark(Blip2Benchmark):
+    """
+    Several prompts per image in half precision, as with `--prompts` on a GPU
+
+    The Q-Former stays in float32 when the rest of the model is loaded in
+    float16, so this also checks that its output is cast before projection.
+    """
+    dtype = "float16"
+    prompts = ["", "question: what is in the picture? answer:"]
+
+
+class StormtrooperBenchmark(ServiceBenchmark):
+    folder = "stormtrooper"
+    model_type = "textgen"
+    max_new_tokens = 8
+
+    def build(self, model_dir):
+        if self.model_type == "textgen":
+            tiny_models.build_causal_lm(model_dir.joinpath("stormtrooper-textgen"))
+        else:
+            tiny_models.build_seq2seq_lm(model_dir.joinpath("stormtrooper-text2text"))
+
+    def load(self, model_dir):
+        interface = importlib.import_module("interface")
+
+        model_name = str(model_dir.joinpath(f"stormtrooper-{self.model_type}"))
+        predictor = interface.load_predictor(self.model_type, model_name, {label: [] for label in labels})
+        # the prefix cache wraps the stormtrooper classifier
+        getattr(predictor, "predictor", predictor).max_new_tokens = self.max_new_tokens
+        return interface, predictor
+
+    def items(self, work_dir, count):
+        return tiny_models.synthetic_texts(count)
+
+    def run(self, state, batch):
+        interface, predictor = state
+        interface.LengthBucketedBatcher(predictor, max_batch_size=len(batch)).predict(batch)
+
+
+class StormtrooperText2TextBenchmark(StormtrooperBenchmark):
+    model_type = "text2text"
+
+
+class StableDiffusionBenchmark(ServiceBenchmark):
+    folder = "stable_diffusion"
+    preset = "draft"
+    steps = 4
+
+    def build(self, model_dir):
+        tiny_models.build_sdxl(model_dir.joinpath("stable_diffusion"))
+
+    def load(self, model_dir):
+        interface = importlib.import_module("interface")
+
+        # the pipelines are loaded from the working directory, as in the Docker image
+        os.chdir(model_dir.joinpath("stable_diffusion"))
+        base, refiner = interface.load_sdxl1("cpu", "float32")
+        interface.set_scheduler([base, refiner], self.preset)
+        return interface, interface.PromptEncoder(base, refiner), base, refiner
+
+    def items(self, work_dir, count):
+        # some prompts repeat, as they often do in prompt files
+        rng = random.Random(0)
+        texts = tiny_models.synthetic_texts(max(1, count // 2), max_words=20)
+        return [{"prompt": rng.choice(texts), "negative": ""} for _ in range(count)]
+
+    def run(self, state, batch):
+        interface, encoder, base, refiner = state
+        base_kwargs, refiner_kwargs = encoder.encode_batch(batch)
+        interface.generate_batch(base, refiner, base_kwargs, refiner_kwargs, self.steps)
+
+
+benchmarks = {
+    "clip": ClipBenchmark(),
+    "image_classifier": ImageClassifierBenchmark(),
+    "blip2": Blip2Benchmark(),
+    "blip2_prompts_fp16": Blip2PromptsFloat16Benchmark(),
+    "stormtrooper": StormtrooperBenchmark(),
+    "stormtrooper_text2text": StormtrooperText2TextBenchmark(),
+    "stable_diffusion": StableDiffusionBenchmark(),
+}
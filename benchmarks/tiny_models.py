@@ -0,0 +1,249 @@
+"""
+Tiny, randomly initialised models with the same architectures as the services use
+
+The models are built from scratch and saved to a local folder, so that
+benchmarks run without network access or downloaded weights, and quickly
+enough on a CPU. Their output is meaningless, but they exercise the same code
+paths as the real models. Each builder takes the folder to save the model in
+and returns the path (or object) the service loads.
+"""
+import json
+import random
+
+import torch
+
+from pathlib import Path
+
+# a short corpus for the tiny tokenizers; the vocabulary only needs to cover
+# the synthetic texts and prompts used by the benchmarks reasonably well
+WORDS = ["the", "a", "of", "and", "to", "in", "is", "that", "it", "for", "on", "with", "as", "was", "photo", "image",
+         "picture", "people", "street", "city", "dog", "cat", "tree", "house", "car", "protest", "sign", "crowd",
+         "news", "politics", "sport", "music", "positive", "negative", "neutral", "happy", "angry", "sad", "today",
+         "question", "answer", "what", "who", "where", "describe", "classify", "label", "text", "document", "example",
+         "lighthouse", "coast", "sunset", "portrait", "painting", "style", "red", "blue", "green", "large", "small"]
+
+
+def synthetic_texts(count, seed=0, min_words=3, max_words=60):
+    """
+    Generate texts of varying length from `WORDS`
+
+    :param int count:  Number of texts
+    :param int seed:  Random seed, so texts are the same for every run
+    :param int min_words:  Minimum number of words per text
+    :param int max_words:  Maximum number of words per text
+    :return list:  Texts
+    """
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=rng.randint(min_words, max_words))) for _ in range(count)]
+
+
+def build_tokenizer(path, vocab_size=512):
+    """
+    Train a small byte-level BPE tokenizer
+
+    :param Path path:  Folder to save the tokenizer in
+    :param int vocab_size:  Vocabulary size
+    :return:  `PreTrainedTokenizerFast`
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<pad>", "<eos>", "<unk>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(synthetic_texts(2000, seed=1), trainer)
+
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", eos_token="<eos>",
+                                        unk_token="<unk>", model_input_names=["input_ids", "attention_mask"])
+    tokenizer.save_pretrained(path)
+    return tokenizer
+
+
+def build_clip(path):
+    """
+    Build a tiny OpenAI CLIP model
+
+    The model is saved as a TorchScript archive, like the released checkpoints,
+    which `clip.load()` accepts instead of a model name; it infers the
+    architecture from the weights, with one attention head per 64 dimensions.
+    The text vocabulary is CLIP's own, since `clip.tokenize` is used as is.
+
+    :param Path path:  Folder to save the model in
+    :return str:  Checkpoint file
+    """
+    from clip.model import CLIP
+
+    model = CLIP(embed_dim=32, image_resolution=32, vision_layers=2, vision_width=64, vision_patch_size=8,
+                 context_length=77, vocab_size=49408, transformer_width=64, transformer_heads=1, transformer_layers=2)
+    path.mkdir(parents=True, exist_ok=True)
+    checkpoint = path.joinpath("clip-tiny.pt")
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), (torch.zeros(1, 3, 32, 32), torch.zeros(1, 77, dtype=torch.long)))
+    traced.save(str(checkpoint))
+    return str(checkpoint)
+
+
+def build_image_classifier(path, num_labels=20):
+    """
+    Build a tiny ViT image classifier
+
+    :param Path path:  Folder to save the model in
+    :param int num_labels:  Number of classes
+    :return str:  Model path
+    """
+    from transformers import ViTConfig, ViTForImageClassification, ViTImageProcessor
+
+    config = ViTConfig(image_size=32, patch_size=8, hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                       intermediate_size=64, num_labels=num_labels, id2label={i: f"label {i}" for i in range(num_labels)},
+                       label2id={f"label {i}": i for i in range(num_labels)})
+    ViTForImageClassification(config).save_pretrained(path)
+    ViTImageProcessor(size={"height": 32, "width": 32}).save_pretrained(path)
+    return str(path)
+
+
+def build_blip2(path):
+    """
+    Build a tiny BLIP2 model with an OPT language model
+
+    :param Path path:  Folder to save the model and processor in
+    :return str:  Model path
+    """
+    from transformers import Blip2Config, Blip2ForConditionalGeneration, Blip2Processor, BlipImageProcessor, \
+        OPTConfig
+
+    # the processor puts one image token per query token before the prompt, which the model replaces with the
+    # projected query outputs
+    tokenizer = build_tokenizer(path)
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<image>"]})
+    config = Blip2Config(
+        vision_config={"hidden_size": 32, "intermediate_size": 64, "num_hidden_layers": 2, "num_attention_heads": 2,
+                       "image_size": 32, "patch_size": 8},
+        qformer_config={"hidden_size": 32, "intermediate_size": 64, "num_hidden_layers": 2, "num_attention_heads": 2,
+                        "encoder_hidden_size": 32, "vocab_size": 512},
+        text_config=OPTConfig(vocab_size=len(tokenizer), hidden_size=32, ffn_dim=64, num_hidden_layers=2,
+                              num_attention_heads=2, word_embed_proj_dim=32, max_position_embeddings=128,
+                              pad_token_id=tokenizer.pad_token_id, bos_token_id=tokenizer.eos_token_id,
+                              eos_token_id=tokenizer.eos_token_id).to_dict(),
+        num_query_tokens=4,
+        image_token_index=tokenizer.convert_tokens_to_ids("<image>"),
+    )
+    Blip2ForConditionalGeneration(config).save_pretrained(path)
+    Blip2Processor(image_processor=BlipImageProcessor(size={"height": 32, "width": 32}), tokenizer=tokenizer,
+                   num_query_tokens=config.num_query_tokens).save_pretrained(path)
+    return str(path)
+
+
+def build_causal_lm(path):
+    """
+    Build a tiny Falcon model, for stormtrooper's `textgen` models
+
+    :param Path path:  Folder to save the model in
+    :return str:  Model path
+    """
+    from transformers import FalconConfig, FalconForCausalLM
+
+    tokenizer = build_tokenizer(path)
+    config = FalconConfig(vocab_size=len(tokenizer), hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                          bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id,
+                          pad_token_id=tokenizer.pad_token_id)
+    FalconForCausalLM(config).save_pretrained(path)
+    return str(path)
+
+
+def build_seq2seq_lm(path):
+    """
+    Build a tiny T5 model, for stormtrooper's `text2text` models
+
+    :param Path path:  Folder to save the model in
+    :return str:  Model path
+    """
+    from transformers import T5Config, T5ForConditionalGeneration
+
+    tokenizer = build_tokenizer(path)
+    config = T5Config(vocab_size=len(tokenizer), d_model=32, d_kv=8, d_ff=64, num_layers=2, num_heads=4,
+                      decoder_start_token_id=tokenizer.pad_token_id, pad_token_id=tokenizer.pad_token_id,
+                      eos_token_id=tokenizer.eos_token_id)
+    T5ForConditionalGeneration(config).save_pretrained(path)
+    return str(path)
+
+
+def build_clip_tokenizer(path):
+    """
+    Build a CLIP tokenizer without merges, i.e. one token per character
+
+    :param Path path:  Folder to save the tokenizer in
+    :return:  `CLIPTokenizer`
+    """
+    from transformers import CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    characters = list(bytes_to_unicode().values())
+    vocab = characters + [f"{character}</w>" for character in characters] + ["<|startoftext|>", "<|endoftext|>"]
+    path.mkdir(parents=True, exist_ok=True)
+    path.joinpath("vocab.json").write_text(json.dumps({token: index for index, token in enumerate(vocab)}))
+    path.joinpath("merges.txt").write_text("#version: 0.2\n")
+
+    tokenizer = CLIPTokenizer(str(path.joinpath("vocab.json")), str(path.joinpath("merges.txt")), model_max_length=77)
+    tokenizer.save_pretrained(path)
+    return tokenizer
+
+
+def build_sdxl(path):
+    """
+    Build tiny SDXL base and refiner pipelines
+
+    They are saved as fp16 variants in `stable-diffusion-xl-base-1.0` and
+    `stable-diffusion-xl-refiner-1.0`, where `load_sdxl1` expects them.
+
+    :param Path path:  Folder to save the pipelines in
+    :return str:  Folder to run the service in
+    """
+    from diffusers import AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLImg2ImgPipeline, \
+        StableDiffusionXLPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection
+
+    path = Path(path)
+    tokenizer = build_clip_tokenizer(path.joinpath("tokenizer"))
+    text_config = CLIPTextConfig(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=37, num_hidden_layers=2,
+                                 num_attention_heads=4, max_position_embeddings=77, projection_dim=32,
+                                 bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+                                 pad_token_id=tokenizer.pad_token_id)
+    text_encoder = CLIPTextModel(text_config)
+    text_encoder_2 = CLIPTextModelWithProjection(text_config)
+
+    def unet(cross_attention_dim, time_ids):
+        # pooled text embeddings plus one embedding per micro-conditioning value
+        return UNet2DConditionModel(
+            block_out_channels=(32, 64), layers_per_block=1, sample_size=32, in_channels=4, out_channels=4,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+            attention_head_dim=(2, 4), use_linear_projection=True, addition_embed_type="text_time",
+            addition_time_embed_dim=8, transformer_layers_per_block=(1, 1), cross_attention_dim=cross_attention_dim,
+            projection_class_embeddings_input_dim=time_ids * 8 + 32)
+
+    vae = AutoencoderKL(block_out_channels=[32, 64], in_channels=3, out_channels=3, latent_channels=4,
+                        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+                        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"], sample_size=64)
+    scheduler = EulerDiscreteScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                                       steps_offset=1, timestep_spacing="leading")
+
+    StableDiffusionXLPipeline(vae=vae, text_encoder=text_encoder, text_encoder_2=text_encoder_2, tokenizer=tokenizer,
+                              tokenizer_2=tokenizer, unet=unet(64, 6), scheduler=scheduler) \
+        .save_pretrained(path.joinpath("stable-diffusion-xl-base-1.0"), variant="fp16")
+    StableDiffusionXLImg2ImgPipeline(vae=vae, text_encoder=None, text_encoder_2=text_encoder_2, tokenizer=None,
+                                     tokenizer_2=tokenizer, unet=unet(32, 5), scheduler=scheduler,
+                                     requires_aesthetics_score=True, force_zeros_for_empty_prompt=False) \
+        .save_pretrained(path.joinpath("stable-diffusion-xl-refiner-1.0"), variant="fp16")
+
+    return str(path)
+
+
+def seed(value=0):
+    """
+    Make model initialisation and generation repeatable
+
+    :param int value:  Seed
+    """
+    random.seed(value)
+    torch.manual_seed(value)
@@ -0,0 +1,56 @@
+"""
+Measure BLIP2 captioning throughput for different batch sizes and dtypes
+
+Uses synthetic images, so no dataset is needed. For example, to compare the
+CPU options:
+
+    python3 benchmark.py --cpu --dtypes float32,bfloat16,int8 --batch-sizes 1,4,8
+"""
+import argparse
+import time
+
+import PIL.Image
+
+import interface
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--model", "-m", help="Model to benchmark", default="Salesforce/blip2-opt-2.7b")
+    cli.add_argument("--images", "-n", help="Number of synthetic images per configuration (default 16)", type=int, default=16)
+    cli.add_argument("--batch-sizes", "-b", help="Comma-separated batch sizes (default 1,4,8)", default="1,4,8")
+    cli.add_argument("--dtypes", "-d", help=f"Comma-separated dtypes (options: {', '.join(interface.dtypes)}; default auto)", default="auto")
+    cli.add_argument("--max_new_tokens", "-t", help="Maximum number of tokens to generate (default 20)", type=int, default=20)
+    cli.add_argument("--prompt", "-p", help="Prompt to use, if any", default=None)
+    cli.add_argument("--cpu", help="Run on CPU even if a GPU is available", action="store_true", default=False)
+    args = cli.parse_args()
+
+    if args.cpu:
+        interface.device = "cpu"
+
+    images = [PIL.Image.effect_noise((224, 224), 64 + i).convert("RGB") for i in range(args.images)]
+
+    results = []
+    for dtype in args.dtypes.split(","):
+        dtype = interface.resolve_dtype(dtype, interface.device)
+        start = time.time()
+        processor, model, input_dtype = interface.load_model(args.model, dtype)
+        load_time = time.time() - start
+
+        for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+            # warm up, so one-off initialisation is not measured
+            interface.caption_batch(processor, model, images[:batch_size], args.prompt, args.max_new_tokens, input_dtype)
+
+            start = time.time()
+            for batch in interface.batched(images, batch_size):
+                interface.caption_batch(processor, model, batch, args.prompt, args.max_new_tokens, input_dtype)
+            elapsed = time.time() - start
+
+            results.append((dtype, batch_size, load_time, len(images) / elapsed))
+            print(f"{dtype:>9s}, batch size {batch_size:>3d}: {len(images) / elapsed:.2f} images/sec")
+
+        del model
+
+    print(f"\n{'dtype':>9s} {'batch':>6s} {'load (s)':>9s} {'images/sec':>11s}")
+    for dtype, batch_size, load_time, throughput in results:
+        print(f"{dtype:>9s} {batch_size:>6d} {load_time:>9.1f} {throughput:>11.2f}")
@@ -0,0 +1,148 @@
+"""
+Status updates for the DMI Service Manager
+
+Services report progress to the DMI Service Manager via its `status_update`
+endpoint. Sending an HTTP request for every processed item would stall
+processing whenever the Service Manager is slow, so updates are sent from a
+background thread over a pooled connection, and coalesced: only the most
+recent status is sent, at most once per interval (or once every so many
+records). The final status is always sent when the reporter is closed or the
+process exits.
+
+This file is identical in every service folder, since each service is built
+from its own folder as Docker context.
+"""
+import atexit
+import os
+import threading
+import time
+import weakref
+from urllib.parse import quote_plus
+
+import requests
+
+_reporters = weakref.WeakSet()
+
+
+def close_all():
+    """
+    Close all open reporters, sending their final status
+    """
+    for reporter in list(_reporters):
+        reporter.close()
+
+
+atexit.register(close_all)
+
+
+class StatusReporter:
+    """
+    Coalescing, non-blocking status reporter
+
+    `log()` prints the message and queues it as the current status. A
+    background thread sends the current status when `interval` seconds have
+    passed since the previous update, or when `num_records` has advanced by at
+    least `every_records` since then.
+    """
+    def __init__(self, server=None, db_key=None, interval=None, every_records=None):
+        """
+        :param str server:  DMI Service Manager server address; no updates are sent if empty
+        :param str db_key:  DMI Service Manager database key; no updates are sent if empty
+        :param float interval:  Minimum seconds between updates; defaults to `DMI_STATUS_INTERVAL` or 5
+        :param int every_records:  Also send an update when this many records have been processed since the previous
+        one; defaults to `DMI_STATUS_RECORDS` or 0 (disabled)
+        """
+        self.server = server
+        self.db_key = db_key
+        self.interval = float(os.environ.get("DMI_STATUS_INTERVAL", 5) if interval is None else interval)
+        self.every_records = int(os.environ.get("DMI_STATUS_RECORDS", 0) if every_records is None else every_records)
+
+        self.enabled = bool(server and db_key)
+        self.pending = None
+        self.sent_records = 0
+        self.last_sent = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        # statistics, for profiling
+        self.logged = 0
+        self.sent = 0
+        self.failed = 0
+        self.send_seconds = 0
+
+        if self.enabled:
+            self.session = requests.Session()
+            self.thread = threading.Thread(target=self._run, name="dmi-status", daemon=True)
+            self.thread.start()
+            _reporters.add(self)
+
+    def log(self, message, num_records=None):
+        """
+        Print a status message and queue it to be sent to the Service Manager
+
+        :param str message:  Status message
+        :param int num_records:  Number of records processed so far
+        """
+        print(message)
+        if not self.enabled or self.closed:
+            return
+
+        with self.condition:
+            self.pending = (message, num_records)
+            self.logged += 1
+            self.condition.notify()
+
+    def close(self):
+        """
+        Send the last queued status, if any, and stop the background thread
+        """
+        if not self.enabled or self.closed:
+            return
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        self.thread.join()
+        self.session.close()
+
+    def _due(self):
+        message, num_records = self.pending
+        if self.every_records and num_records and num_records - self.sent_records >= self.every_records:
+            return True
+
+        return time.monotonic() - self.last_sent >= self.interval
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (self.pending is None or not self._due()):
+                    # wake up when the interval expires, so the most recent status is never held back for long
+                    timeout = self.interval - (time.monotonic() - self.last_sent) if self.pending else None
+                    self.condition.wait(max(timeout, 0.01) if timeout is not None else None)
+
+                status = self.pending
+                self.pending = None
+                closed = self.closed
+
+            if status:
+                self._send(*status)
+
+            if closed:
+                break
+
+    def _send(self, message, num_records=None):
+        self.last_sent = time.monotonic()
+        if num_records is not None:
+            self.sent_records = num_records
+
+        start = time.monotonic()
+        try:
+            self.session.post(f"{self.server}/status_update/?key={self.db_key}&status=running&message={quote_plus(message)}{'&num_records=' + str(num_records) if num_records else ''}",
+                              timeout=30)
+            self.sent += 1
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to log status update: {e}")
+            self.failed += 1
+
+        self.send_seconds += time.monotonic() - start
@@ -1,9 +1,12 @@
 import argparse
-import requests
+import itertools
 import json
+import os
+import time
 import PIL
-from urllib.parse import quote_plus
 from pathlib import Path
+from dmi_status import StatusReporter
+from dmi_profile import Profiler, annotate, stage, timed
 from transformers import AutoProcessor, Blip2ForConditionalGeneration
 import torch
 
@@ -12,15 +15,25 @@ model_types = ["Salesforce/blip2-opt-2.7b"]
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-def parse_args():
+dtypes = ["auto", "float16", "bfloat16", "float32", "int8"]
+
+def parse_args(argv=None):
     """
     Parse command line arguments
+
+    :param list argv:  Arguments to parse; `sys.argv` if `None`
     """
     cli = argparse.ArgumentParser()
     cli.add_argument("--image-folder", "-i", help="Path to folder containing images", required=True)
     cli.add_argument("--model", "-m", help=f"Model for (options: {', '.join(model_types)})", default="Salesforce/blip2-opt-2.7b")
     cli.add_argument("--max_new_tokens", "-t", help=f"Maximum number of tokens to be generated for model caption/response.", type=int, default=20)
     cli.add_argument("--prompt", "-p", help="Output directory where annotations will be saved", default=None)
+    cli.add_argument("--prompts", nargs="+", help="Several prompts to answer for each image, reusing the image encoding for all of them; use \"\" for a plain caption", default=None)
+    cli.add_argument("--prompts-file", help="File with prompts to answer for each image, one per line (alternative to --prompts)", default=None)
+    cli.add_argument("--batch-size", "-b", help="Number of images to caption at once (default 1)", type=int, default=1)
+    cli.add_argument("--dtype", help=f"Model precision (options: {', '.join(dtypes)}); 'auto' uses float16 on GPU and float32 on CPU, 'int8' quantizes linear layers (CPU only)", choices=dtypes, default="auto")
+    cli.add_argument("--resume", "-r", help="Keep existing results in the output file and only process images that are not in it yet", action="store_true", default=False)
+    cli.add_argument("--profile", help="Time each processing stage and write a summary to [dataset name]-profile.json in the output directory (or set DMI_PROFILE=1)", action="store_true", default=False)
     cli.add_argument("--output-dir", "-o", help="Output directory where annotations will be saved", default="data", required=True)
     cli.add_argument("--dataset-name", "-d", help="Dataset name (to use for output file)", required=True)
     # These arguments are added by the DMI Service Manager in order for the service to, if desired, provide status updates which will be logged in the DMI Service Manager database.
@@ -28,59 +41,289 @@ def parse_args():
                      help="DMI Service Manager database key to provide status updates.")
     cli.add_argument("--dmi_sm_server", "-s", default="",
                      help="DMI Service Manager server address to provide status updates.")
-    return cli.parse_args()
+    return cli.parse_args(argv)
 
-def log(message, server=None, db_key=None, num_records=None):
-    print(message)
-    if server and db_key:
-        try:
-            requests.post(f"{server}/status_update/?key={db_key}&status=running&message={quote_plus(message)}{'&num_records=' + str(num_records) if num_records else ''}")
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to log status update: {e}")
 
-if __name__ == "__main__":
-    args = parse_args()
+def resolve_dtype(dtype, device):
+    """
+    Pick the model precision for a device
+
+    float16 is fast on GPUs, but very slow (or unsupported) for matrix
+    multiplications on most CPUs, so use float32 there unless told otherwise.
+
+    :param str dtype:  One of `dtypes`
+    :param str device:  `cuda` or `cpu`
+    :return str:  Resolved dtype
+    """
+    if dtype == "auto":
+        return "float16" if device == "cuda" else "float32"
+
+    if dtype == "int8" and device != "cpu":
+        raise ValueError("int8 quantization is only supported on CPU")
+
+    return dtype
+
+
+def load_model(model_name, dtype="float16"):
+    """
+    Load processor and model
+
+    :param str model_name:  Model name
+    :param str dtype:  Resolved dtype, see `resolve_dtype`
+    :return tuple:  Processor, model, and the dtype for floating point inputs
+    """
+    processor = AutoProcessor.from_pretrained(model_name)
+    # generate() continues from the end of the input, so pad prompts on the left
+    processor.tokenizer.padding_side = "left"
+
+    torch_dtype = torch.float32 if dtype == "int8" else getattr(torch, dtype)
+    model = Blip2ForConditionalGeneration.from_pretrained(model_name, torch_dtype=torch_dtype)
+    model.to(device)
+    model.eval()
+
+    if dtype == "int8":
+        # dynamic quantization: int8 weights for linear layers, activations quantized on the fly
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    return processor, model, torch_dtype
+
+
+def open_image(path):
+    """
+    Open an image as RGB
+
+    :param Path path:  Image file
+    :return:  RGB image, or `None` if it could not be opened
+    """
+    try:
+        image_obj = PIL.Image.open(path)
+        # decode now, so that truncated or corrupt files are caught here rather than by the processor
+        image_obj.load()
+        if image_obj.mode != "RGB":
+            image_obj = image_obj.convert("RGB")
+    except Exception:
+        # besides OSError (incl. PIL.UnidentifiedImageError), corrupt or oversized files raise e.g. SyntaxError,
+        # ValueError or PIL.Image.DecompressionBombError
+        print(f"Unable to open image {path.name}")
+        return None
+
+    return image_obj
+
+
+def caption_batch(processor, model, image_objs, prompt=None, max_new_tokens=20, input_dtype=torch.float16):
+    """
+    Generate captions (or answers to a prompt) for a batch of images
+
+    All images are processed in a single `generate` call.
+
+    :param processor:  BLIP2 processor
+    :param model:  BLIP2 model
+    :param list image_objs:  RGB images
+    :param str prompt:  Prompt, or `None` for a plain caption
+    :param int max_new_tokens:  Maximum number of tokens to generate
+    :param input_dtype:  dtype for the pixel values
+    :return list:  Generated text per image, without the prompt
+    """
+    prompts = {"text": [prompt] * len(image_objs), "padding": True} if prompt else {}
+    with stage("preprocess", items=len(image_objs), sync=True):
+        inputs = processor(images=image_objs, return_tensors="pt", **prompts).to(device, input_dtype)
+    # Generate text
+    # max_new_tokens is in BLIP examples; there is also min_length and max_length, but they seem to behave oddly with the prompt parameter
+    with stage("model", items=len(image_objs), sync=True), torch.no_grad():
+        generated_ids = model.generate(**inputs, max_new_tokens=max_new_tokens)
+
+    # depending on the version of transformers, the output may start with the prompt; only keep the answer, as
+    # `answer_prompts` does
+    input_ids = inputs.get("input_ids")
+    if input_ids is not None and generated_ids.shape[1] >= input_ids.shape[1] \
+            and torch.equal(generated_ids[:, :input_ids.shape[1]], input_ids):
+        generated_ids = generated_ids[:, input_ids.shape[1]:]
+
+    # skip_special_tokens is in BLIP examples; unsure what tokens they have marked as special to be removed
+    return [text.strip() for text in processor.batch_decode(generated_ids, skip_special_tokens=True)]
+
+
+def encode_images(model, pixel_values):
+    """
+    Run the vision encoder and Q-Former, and project the result into the language model's embedding space
+
+    This mirrors the first part of `Blip2ForConditionalGeneration.generate`, so
+    the result can be reused for several prompts.
+
+    :param model:  BLIP2 model
+    :param torch.Tensor pixel_values:  Processed images
+    :return torch.Tensor:  Language model input embeddings, shape (images, query tokens, hidden size)
+    """
+    image_embeds = model.vision_model(pixel_values, return_dict=True).last_hidden_state
+    image_attention_mask = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+
+    query_tokens = model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+    query_output = model.qformer(query_embeds=query_tokens, encoder_hidden_states=image_embeds,
+                                 encoder_attention_mask=image_attention_mask, return_dict=True).last_hidden_state
+
+    # the Q-Former is kept in float32 when loading the model in half precision, but the projection is not
+    query_output = query_output.to(image_embeds.dtype)
+    return model.language_projection(query_output)
+
+
+def answer_prompts(processor, model, image_objs, prompts, max_new_tokens=20, input_dtype=torch.float16):
+    """
+    Answer several prompts for a batch of images
+
+    The images are encoded once, and the encoding is shared by all prompts,
+    which are then answered with a single `generate` call on the language
+    model.
+
+    :param processor:  BLIP2 processor
+    :param model:  BLIP2 model
+    :param list image_objs:  RGB images
+    :param list prompts:  Prompts; an empty prompt generates a plain caption
+    :param int max_new_tokens:  Maximum number of tokens to generate
+    :param input_dtype:  dtype for the pixel values
+    :return list:  For each image, a dict of prompt -> generated text
+    """
+    with stage("preprocess", items=len(image_objs), sync=True):
+        pixel_values = processor(images=image_objs, return_tensors="pt").pixel_values.to(device, input_dtype)
+
+    with stage("model", items=len(image_objs), sync=True), torch.no_grad():
+        image_inputs = encode_images(model, pixel_values)
+
+        # one row per (image, prompt) combination; prompts are padded on the left
+        text = processor.tokenizer(prompts, padding=True, return_tensors="pt").to(device)
+        num_images, num_prompts = image_inputs.shape[0], len(prompts)
+        image_inputs = image_inputs.repeat_interleave(num_prompts, dim=0)
+        input_ids = text.input_ids.repeat(num_images, 1)
+        text_attention_mask = text.attention_mask.repeat(num_images, 1)
+
+        text_embeds = model.get_input_embeddings()(input_ids).to(image_inputs.dtype)
+        inputs_embeds = torch.cat([image_inputs, text_embeds], dim=1)
+        attention_mask = torch.cat([torch.ones(image_inputs.size()[:-1], dtype=torch.long, device=device),
+                                    text_attention_mask], dim=1)
+
+        generated_ids = model.language_model.generate(inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                                                      max_new_tokens=max_new_tokens)
+
+    generated = [text.strip() for text in processor.batch_decode(generated_ids, skip_special_tokens=True)]
+    return [dict(zip(prompts, generated[i * num_prompts:(i + 1) * num_prompts])) for i in range(num_images)]
+
+
+def read_processed(path):
+    """
+    Find out which images are already in an output file
+
+    If the previous run was interrupted while writing, the last line may be
+    incomplete; the file is truncated to the last complete line, so new
+    results can be appended.
+
+    :param Path path:  Output file
+    :return set:  Names of images that are already in the file
+    """
+    processed = set()
+    if not path.exists():
+        return processed
+
+    valid_size = 0
+    with path.open("rb") as infile:
+        for line in infile:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                processed.update(json.loads(line))
+            except ValueError:
+                break
+            valid_size += len(line)
+
+    if valid_size < path.stat().st_size:
+        print(f"Discarding incomplete results at the end of {path.name}")
+        with path.open("r+b") as outfile:
+            outfile.truncate(valid_size)
+
+    return processed
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def main(argv=None, models=None):
+    """
+    Run BLIP2 with the given command line arguments
+
+    :param list argv:  Command line arguments; `sys.argv` if `None`
+    :param models:  `dmi_worker.ModelCache` to keep models loaded between runs, when running as a worker
+    """
+    args = parse_args(argv)
+    status = StatusReporter(args.dmi_sm_server, args.database_key)
+    load = models.get if models is not None else lambda key, loader: loader()
 
     output_folder = Path(args.output_dir)
     if not output_folder.exists():
-        log(f"Output folder {args.output_dir} not found.", args.dmi_sm_server, args.database_key)
+        status.log(f"Output folder {args.output_dir} not found.")
+        exit(1)
+
+    try:
+        dtype = resolve_dtype(args.dtype, device)
+    except ValueError as e:
+        status.log(str(e))
         exit(1)
 
     # Setup models
-    log("Setting up model...", args.dmi_sm_server, args.database_key)
-    processor = AutoProcessor.from_pretrained(args.model)
-    # TODO: check torch_dtype usage
-    model = Blip2ForConditionalGeneration.from_pretrained(args.model, torch_dtype=torch.float16)
-    model.to(device)
+    status.log(f"Setting up model ({dtype} on {device})...")
+    processor, model, input_dtype = load(("blip2", args.model, dtype), lambda: load_model(args.model, dtype))
 
-    # Prompt if provided
-    prompt = {"text": args.prompt} if args.prompt else {}
+    if args.prompts_file:
+        with open(args.prompts_file) as infile:
+            prompts = [line.strip() for line in infile if line.strip()]
+    else:
+        prompts = args.prompts
 
-    done = 0
-    log("Processing images...", args.dmi_sm_server, args.database_key)
-    with output_folder.joinpath(args.dataset_name + ".ndjson").open("w") as outfile:
-        images = Path(args.image_folder)
-        for image in images.glob("*"):
-            metadata = {}
+    output_path = output_folder.joinpath(args.dataset_name + ".ndjson")
+    processed = read_processed(output_path) if args.resume else set()
 
-            try:
-                image_obj = PIL.Image.open(image)
-            except PIL.UnidentifiedImageError:
-                print(f"Unable to open image {image.name}")
-                continue
-
-            if image_obj.mode != "RGB":
-                image_obj = image_obj.convert("RGB")
-
-            # Process image
-            inputs = processor(image_obj, return_tensors="pt", **prompt).to(device, torch.float16)
-            # Generate text
-            # max_new_tokens is in BLIP examples; there is also min_length and max_length, but they seem to behave oddly with the prompt parameter
-            generated_ids = model.generate(**inputs, max_new_tokens=args.max_new_tokens)
-            # skip_special_tokens is in BLIP examples; unsure what tokens they have marked as special to be removed
-            generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0].strip()
-            metadata["text"] = generated_text
-
-            done += 1
-            outfile.write(json.dumps({image.name: metadata}) + "\n")
-            log(f"Processed {done} images", args.dmi_sm_server, args.database_key, num_records=done)
+    # process in a fixed order, so progress is comparable between (resumed) runs
+    images = sorted(Path(args.image_folder).glob("*"))
+    todo = [image for image in images if image.name not in processed]
+
+    done = len(images) - len(todo)
+    processed_now = 0
+    start = time.time()
+    status.log(f"Processing images ({done} of {len(images)} already done)..." if done else "Processing images...",
+               num_records=done)
+    profiler = Profiler(args.profile)
+    with output_path.open("a" if args.resume else "w") as outfile:
+        opened = ((image, open_image(image)) for image in todo)
+        for batch in timed("decode", batched(opened, max(1, args.batch_size)), len):
+            readable = [(image, image_obj) for image, image_obj in batch if image_obj is not None]
+            image_objs = [image_obj for image, image_obj in readable]
+            metadata = []
+            if image_objs and prompts:
+                answers = answer_prompts(processor, model, image_objs, prompts, args.max_new_tokens, input_dtype)
+                metadata = [{"answers": image_answers} for image_answers in answers]
+            elif image_objs:
+                generated = caption_batch(processor, model, image_objs, args.prompt, args.max_new_tokens, input_dtype)
+                metadata = [{"text": generated_text} for generated_text in generated]
+            metadata = dict(zip([image for image, image_obj in readable], metadata))
+
+            with stage("write", items=len(batch)):
+                # unreadable images are recorded too, so that they count as done and are not tried again on --resume
+                for image, image_obj in batch:
+                    outfile.write(json.dumps({image.name: metadata.get(image, {"error": "Unable to open image"})}) + "\n")
+
+                # make sure completed batches are on disk, so an interrupted run can be resumed from here
+                outfile.flush()
+                os.fsync(outfile.fileno())
+
+            done += len(batch)
+            processed_now += len(batch)
+            with stage("status"):
+                status.log(annotate(f"Processed {done} of {len(images)} images"), num_records=done)
+
+    elapsed = time.time() - start
+    print(f"Processed {processed_now} images in {elapsed:.1f} seconds ({processed_now / elapsed if elapsed else 0:.2f} images/sec)")
+    profiler.finish(output_folder.joinpath(f"{args.dataset_name}-profile.json"), status)
+
+
+if __name__ == "__main__":
+    main()
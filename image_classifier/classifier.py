@@ -1,14 +1,20 @@
 import argparse
-import requests
+import collections
+import hashlib
+import io
+import itertools
+import os
+import sqlite3
 import numpy as np
 import json
 import torch
 import PIL
-from urllib.parse import quote_plus
-import requests
 
+from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoImageProcessor, AutoModelForImageClassification
 from pathlib import Path
+from dmi_status import StatusReporter
+from dmi_profile import Profiler, annotate, stage, timed
 
 have_cuda = torch.cuda.is_available()
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
@@ -39,9 +45,11 @@ def softmax(_outputs):
     return shifted_exp / shifted_exp.sum(axis=-1, keepdims=True)
 
 
-def parse_args():
+def parse_args(argv=None):
     """
     Parse command line arguments
+
+    :param list argv:  Arguments to parse; `sys.argv` if `None`
     """
     cli = argparse.ArgumentParser()
     cli.add_argument("--image-folder", "-i", help="Path to folder containing images", required=True)
@@ -51,71 +59,231 @@ def parse_args():
     cli.add_argument("--output-dir", "-o", help="Output directory where annotations will be saved", default="data",
                      required=True)
     cli.add_argument("--dataset-name", "-d", help="Dataset name (to use for output file)", required=True)
+    cli.add_argument("--batch-size", "-b", help="Number of images to classify at once (default 1)", default=1, type=int)
+    cli.add_argument("--workers", "-w", help="Number of threads decoding images ahead of classification (default 1)", default=1, type=int)
+    cli.add_argument("--cache-file", help="SQLite file to cache classifier scores in, per image content and model, so images seen before are not classified again", default=os.path.expanduser("~/.cache/dmi_image_classifier.sqlite"))
+    cli.add_argument("--no-cache", help="Do not read or write the score cache", action="store_true", default=False)
     cli.add_argument("--label-threshold", "-t", help="Threshold for confidence in labels to be included in output (default 0.5, or 50%%)", default=0.5, type=float)
+    cli.add_argument("--profile", help="Time each processing stage and write a summary to [dataset name]-profile.json in the output directory (or set DMI_PROFILE=1)", action="store_true", default=False)
     # These arguments are added by the DMI Service Manager in order for the service to, if desired, provide status updates which will be logged in the DMI Service Manager database.
     cli.add_argument("--database_key", "-k", default="",
                      help="DMI Service Manager database key to provide status updates.")
     cli.add_argument("--dmi_sm_server", "-s", default="",
                      help="DMI Service Manager server address to provide status updates.")
-    return cli.parse_args()
+    return cli.parse_args(argv)
 
-def log(message, server=None, db_key=None, num_records=None):
-    print(message)
-    if server and db_key:
-        try:
-            requests.post(f"{server}/status_update/?key={db_key}&status=running&message={quote_plus(message)}{'&num_records=' + str(num_records) if num_records else ''}")
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to log status update: {e}")
 
-if __name__ == "__main__":
-    args = parse_args()
+def load_classifier(model_name):
+    return (AutoImageProcessor.from_pretrained(model_name),
+            AutoModelForImageClassification.from_pretrained(model_name).to(device))
+
+
+class ScoreCache:
+    """
+    Persistent cache of classifier scores
+
+    Scores are stored as raw (softmaxed, but not thresholded) float32 vectors,
+    keyed by the SHA-256 hash of the image file and the classifier's model
+    name, so that a different threshold can be applied when reading them.
+    """
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS scores (hash TEXT, model TEXT, scores BLOB, PRIMARY KEY (hash, model))")
+
+    def get_many(self, hashes, model_name):
+        """
+        :param list hashes:  Image hashes
+        :param str model_name:  Classifier model name
+        :return dict:  Hash -> score vector, for hashes that are in the cache
+        """
+        cached = {}
+        hashes = list(hashes)
+        # stay well below SQLite's limit for the number of query parameters
+        for offset in range(0, len(hashes), 500):
+            chunk = hashes[offset:offset + 500]
+            rows = self.db.execute(f"SELECT hash, scores FROM scores WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                                   (model_name, *chunk))
+            cached.update({digest: np.frombuffer(scores, dtype=np.float32) for digest, scores in rows})
+
+        return cached
+
+    def put_many(self, hashes, model_name, scores):
+        """
+        :param list hashes:  Image hashes
+        :param str model_name:  Classifier model name
+        :param np.ndarray scores:  Score matrix, one row per hash
+        """
+        self.db.executemany("INSERT OR REPLACE INTO scores (hash, model, scores) VALUES (?, ?, ?)",
+                            [(digest, model_name, row.astype(np.float32).tobytes()) for digest, row in zip(hashes, scores)])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def load_image(path):
+    """
+    Open, hash and decode an image
+
+    :param Path path:  Image file
+    :return:  (SHA-256 hash of the file, RGB image) tuple, or `None` if the file is not a usable image
+    """
+    try:
+        data = path.read_bytes()
+        image_obj = PIL.Image.open(io.BytesIO(data))
+        image_obj.load()
+        if image_obj.size == (1, 1):
+            return None
+
+        if image_obj.mode != "RGB":
+            image_obj = image_obj.convert("RGB")
+    except Exception:
+        # besides OSError (incl. PIL.UnidentifiedImageError), corrupt or oversized files raise e.g. SyntaxError,
+        # ValueError or PIL.Image.DecompressionBombError; this runs in a decoding thread, so anything raised here would
+        # abort the whole run rather than skip the image
+        return None
+
+    return hashlib.sha256(data).hexdigest(), image_obj
+
+
+def decode_images(paths, workers=1, prefetch=64):
+    """
+    Decode images in background threads, ahead of classification
+
+    At most `prefetch` images are decoded ahead of the consumer, so memory use
+    stays bounded for large folders.
+
+    :param paths:  Iterable of image files
+    :param int workers:  Number of decoding threads
+    :param int prefetch:  Number of images to decode ahead
+    :return:  Generator of (path, hash, image) tuples, in the order of `paths`, for usable images only
+    """
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = collections.deque((path, pool.submit(load_image, path)) for path in itertools.islice(paths, prefetch))
+        while pending:
+            path, future = pending.popleft()
+            for next_path in itertools.islice(paths, 1):
+                pending.append((next_path, pool.submit(load_image, next_path)))
+
+            loaded = future.result()
+            if loaded is not None:
+                yield path, *loaded
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def classify_batch(image_objs, threshold, cache=None):
+    """
+    Run all enabled classifiers on a batch of images
+
+    Each classifier runs once for the whole batch, and threshold filtering is
+    applied to the full score matrix at once. Images with identical content
+    are only classified once, and if a cache is given, images of which the
+    scores are cached are not classified at all.
+
+    :param dict image_objs:  Image hash -> RGB image
+    :param float threshold:  Only include labels with a higher score than this
+    :param ScoreCache cache:  Score cache, or `None`
+    :return dict:  For each image hash, classifier -> {label: score}
+    """
+    hashes = list(image_objs)
+    metadata = {digest: {} for digest in hashes}
+    for classifier, settings in classifiers.items():
+        if not settings["preprocessor"]:
+            continue
+
+        model_name = settings["model_name"]
+        with stage("cache", items=len(hashes)):
+            scores = cache.get_many(hashes, model_name) if cache else {}
+        uncached = [digest for digest in hashes if digest not in scores]
+
+        if uncached:
+            with stage("preprocess", items=len(uncached), sync=True):
+                inputs = settings["preprocessor"]([image_objs[digest] for digest in uncached], return_tensors="pt").to(device)
+
+            with stage("model", items=len(uncached), sync=True), torch.no_grad():
+                output = settings["model"](**inputs).logits
+
+            new_scores = softmax(output.float().cpu().numpy())
+            scores.update(zip(uncached, new_scores))
+            if cache:
+                with stage("cache"):
+                    cache.put_many(uncached, model_name, new_scores)
+
+        score_matrix = np.stack([scores[digest] for digest in hashes])
+        for digest in hashes:
+            metadata[digest][classifier] = {}
+
+        id2label = settings["model"].config.id2label
+        for row, column in zip(*np.nonzero(score_matrix > threshold)):
+            metadata[hashes[row]][classifier][id2label[column.item()]] = score_matrix[row, column].item()
+
+    return metadata
+
+
+def main(argv=None, models=None):
+    """
+    Run the classifiers with the given command line arguments
+
+    :param list argv:  Command line arguments; `sys.argv` if `None`
+    :param models:  `dmi_worker.ModelCache` to keep models loaded between runs, when running as a worker
+    """
+    args = parse_args(argv)
+    status = StatusReporter(args.dmi_sm_server, args.database_key)
+    load = models.get if models is not None else lambda key, loader: loader()
 
     output_folder = Path(args.output_dir)
     if not output_folder.exists():
         print(f"Output folder {args.output_dir} not found.")
         exit(1)
 
-    for classifier, settings in classifiers.items():
-        if not getattr(args, f"with_{classifier}"):
-            continue
+    try:
+        for classifier, settings in classifiers.items():
+            if not getattr(args, f"with_{classifier}"):
+                continue
 
-        classifiers[classifier]["preprocessor"] = AutoImageProcessor.from_pretrained(settings["model_name"])
-        classifiers[classifier]["model"] = AutoModelForImageClassification.from_pretrained(settings["model_name"]).to(
-            device)
+            settings["preprocessor"], settings["model"] = load(("classifier", settings["model_name"]),
+                                                               lambda: load_classifier(settings["model_name"]))
 
-    done = 0
-    with output_folder.joinpath(args.dataset_name + ".ndjson").open("w") as outfile:
-        images = Path(args.image_folder)
-        for image in images.glob("*"):
-            metadata = {}
+        cache = None if args.no_cache else ScoreCache(args.cache_file)
 
-            try:
-                image_obj = PIL.Image.open(image)
-            except PIL.UnidentifiedImageError:
-                continue
+        # annotations for images classified in this run, by image hash, so identical images are only classified once
+        seen = {}
 
-            if image_obj.size == (1, 1):
-                continue
+        profiler = Profiler(args.profile)
+        done = 0
+        with output_folder.joinpath(args.dataset_name + ".ndjson").open("w") as outfile:
+            images = Path(args.image_folder)
+            decoded = decode_images(images.glob("*"), workers=args.workers, prefetch=max(1, args.batch_size, args.workers) * 2)
+            for batch in timed("decode", batched(decoded, max(1, args.batch_size)), len):
+                new_images = {digest: image_obj for path, digest, image_obj in batch if digest not in seen}
+                if new_images:
+                    seen.update(classify_batch(new_images, args.label_threshold, cache))
 
-            if image_obj.mode != "RGB":
-                image_obj = image_obj.convert("RGB")
+                with stage("write", items=len(batch)):
+                    for image, digest, image_obj in batch:
+                        outfile.write(json.dumps({image.name: seen[digest]}) + "\n")
 
-            for classifier, settings in classifiers.items():
-                if not settings["preprocessor"]:
-                    continue
+                done += len(batch)
+                with stage("status"):
+                    status.log(annotate(f"Processed {done} images"), num_records=done)
 
-                inputs = settings["preprocessor"](image_obj, return_tensors="pt").to(device)
+        if cache:
+            cache.close()
 
-                with torch.no_grad():
-                    output = settings["model"](**inputs).logits
-                    scores = softmax(output[0].cpu().numpy())
-                    metadata.update({classifier: {
-                        settings["model"].config.id2label[i]: score.item() for i, score in enumerate(scores) if score > args.label_threshold}
-                    })
+        profiler.finish(output_folder.joinpath(f"{args.dataset_name}-profile.json"), status)
+    finally:
+        # the models are kept in the worker's model cache, if any; holding on to them here as well would stop it from
+        # freeing their memory, and a later run may not enable the same classifiers
+        for settings in classifiers.values():
+            settings["preprocessor"], settings["model"] = None, None
 
-            previous = True
-            done += 1
 
-            outfile.write(json.dumps({image.name: metadata}) + "\n")
-            log(f"Processed {done} images", args.dmi_sm_server, args.database_key, num_records=done)
-            
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,14 @@ exit_backend() {
 
 trap exit_backend INT TERM
 
+# Optionally run a worker that keeps models loaded between jobs (see dmi_worker.py)
+if [ "$DMI_WORKER" = "1" ]; then
+  if [ -n "$DMI_WORKER_SOCKET" ]; then
+    exec python3 dmi_worker.py serve --service classifier --socket "$DMI_WORKER_SOCKET"
+  fi
+  exec python3 dmi_worker.py serve --service classifier --host "${DMI_WORKER_HOST:-127.0.0.1}" --port "${DMI_WORKER_PORT:-4010}"
+fi
+
 # Hang out until SIGTERM received
 while true; do
     sleep 1
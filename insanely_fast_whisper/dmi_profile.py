@@ -0,0 +1,317 @@
+"""
+Per-stage profiling for DMI services
+
+When a job is slow, it is not obvious whether the time goes to decoding
+inputs, preprocessing, the model itself, writing output or status updates.
+Services time each stage of their main loop with `stage()` (or `timed()`, for
+time spent waiting on an iterator); this does nothing unless a `Profiler` is
+active, which is the case when the service is run with `--profile` or with the
+`DMI_PROFILE` environment variable set.
+
+At the end of the run, a JSON summary is written with, per stage, the number
+of calls and items, the time taken and items per second, and how much the
+memory high-water marks (resident memory and, with CUDA, GPU memory) went up
+during the stage. With `DMI_PROFILE_STATUS` set, the per-stage throughput so
+far is also added to the status messages sent to the DMI Service Manager, so
+it shows up next to the number of processed records.
+
+This file is identical in every service folder, since each service is built
+from its own folder as Docker context.
+"""
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+_current = None
+
+
+def enabled_in_environment(variable):
+    return os.environ.get(variable, "").lower() not in ("", "0", "false", "no")
+
+
+def peak_rss():
+    """
+    Get the peak resident memory of this process
+
+    :return int:  Peak resident memory, in bytes
+    """
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def peak_gpu_memory():
+    """
+    Get the peak GPU memory allocated by torch, if CUDA is in use
+
+    :return int:  Peak allocated memory, in bytes; 0 if CUDA is not in use
+    """
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch.cuda.max_memory_allocated()
+
+    return 0
+
+
+def synchronize():
+    # CUDA calls return before the GPU is done, so without this the time would be counted for whichever stage
+    # copies the result back to the CPU; this waits for all GPU work of the process, not just that of the current stage
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+
+class Stage:
+    """
+    Time one call of a stage
+
+    Set `items` within the `with` block if the number of items is not known
+    in advance.
+    """
+    def __init__(self, profiler, name, items=None, sync=False):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+        self.sync = sync
+
+    def __enter__(self):
+        if self.sync:
+            synchronize()
+        self.rss = peak_rss()
+        self.gpu = peak_gpu_memory()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.sync:
+            synchronize()
+        self.profiler.record(self.name, time.perf_counter() - self.start, self.items, peak_rss() - self.rss,
+                             peak_gpu_memory() - self.gpu)
+
+
+class NullStage:
+    """
+    Stand-in for `Stage` when profiling is disabled
+    """
+    items = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_stage = NullStage()
+
+
+def stage(name, items=None, sync=False):
+    """
+    Time a stage with the active profiler, if any
+
+        with stage("model", items=len(batch), sync=True):
+            outputs = model(**inputs)
+
+    :param str name:  Stage name
+    :param int items:  Number of items processed in this call
+    :param bool sync:  Wait for the GPU to finish before and after the stage, so that GPU work is counted for the stage
+    that queued it; only for stages that use the GPU, on the main thread, since other threads would be held up by the
+    GPU work of the main thread
+    :return:  Context manager
+    """
+    return _current.stage(name, items, sync) if _current else _null_stage
+
+
+def timed(name, iterable, count=None):
+    """
+    Time how long is spent waiting for each item of an iterable
+
+    Useful for generators that decode or read input, possibly in the
+    background: the time counted is the time the main loop is held up by them.
+
+    :param str name:  Stage name
+    :param iterable:  Iterable
+    :param callable count:  Function returning the number of items in an item of the iterable, e.g. `len` for batches;
+    each item counts as one if not given
+    :return:  Iterable yielding the same items
+    """
+    return _current.timed(name, iterable, count) if _current else iterable
+
+
+def annotate(message):
+    """
+    Add per-stage throughput to a status message, if enabled
+
+    :param str message:  Status message
+    :return str:  Status message, followed by throughput per stage if the active profiler reports to the status
+    """
+    return _current.annotate(message) if _current else message
+
+
+class Profiler:
+    """
+    Collect per-stage timings and memory use for a run
+
+    Creating an enabled profiler makes it the active one, which `stage()`,
+    `timed()` and `annotate()` use, until `finish()` is called; creating a
+    disabled one stops profiling. One run is profiled at a time per process.
+    """
+    def __init__(self, enabled=False, report_status=None):
+        """
+        :param bool enabled:  Whether to profile; also enabled if the `DMI_PROFILE` environment variable is set
+        :param bool report_status:  Add per-stage throughput to status messages; defaults to whether
+        `DMI_PROFILE_STATUS` is set, and enables profiling if so
+        """
+        global _current
+
+        self.report_status = enabled_in_environment("DMI_PROFILE_STATUS") if report_status is None else report_status
+        self.enabled = bool(enabled or self.report_status or enabled_in_environment("DMI_PROFILE"))
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter()
+
+        if self.enabled:
+            torch = sys.modules.get("torch")
+            if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+                torch.cuda.reset_peak_memory_stats()
+
+        # a previous run in the same worker may have stopped before finishing its profile
+        _current = self if self.enabled else None
+
+    def stage(self, name, items=None, sync=False):
+        return Stage(self, name, items, sync)
+
+    def timed(self, name, iterable, count=None):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as current:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                current.items = count(item) if count else 1
+
+            yield item
+
+    def record(self, name, seconds, items=None, rss_growth=0, gpu_growth=0):
+        """
+        Record one call of a stage
+
+        :param str name:  Stage name
+        :param float seconds:  Time taken
+        :param int items:  Number of items processed
+        :param int rss_growth:  Increase in peak resident memory, in bytes
+        :param int gpu_growth:  Increase in peak GPU memory, in bytes
+        """
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {"calls": 0, "items": 0, "seconds": 0, "max_seconds": 0, "rss_growth": 0,
+                                     "gpu_growth": 0}
+
+            stats = self.stages[name]
+            stats["calls"] += 1
+            stats["items"] += items or 0
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["rss_growth"] += rss_growth
+            stats["gpu_growth"] += gpu_growth
+
+    def throughput(self):
+        """
+        Get items per second per stage, so far
+
+        Stages running in several threads at once count the time of each
+        thread, so this is the throughput per thread.
+
+        :return dict:  Stage name -> items per second, for stages that process items
+        """
+        with self.lock:
+            return {name: stats["items"] / stats["seconds"] for name, stats in self.stages.items()
+                    if stats["items"] and stats["seconds"]}
+
+    def annotate(self, message):
+        if not self.report_status:
+            return message
+
+        throughput = ", ".join([f"{name} {per_second:,.1f}/s" for name, per_second in self.throughput().items()])
+        return f"{message} ({throughput})" if throughput else message
+
+    def summary(self, status=None):
+        """
+        Summarise the run so far
+
+        :param StatusReporter status:  Reporter to include statistics on sent status updates for, if any
+        :return dict:  Summary
+        """
+        wall_time = time.perf_counter() - self.start
+        throughput = self.throughput()
+        megabyte = 1024 * 1024
+        with self.lock:
+            stages = {name: {
+                "calls": stats["calls"],
+                "items": stats["items"],
+                "seconds": round(stats["seconds"], 4),
+                "max_seconds": round(stats["max_seconds"], 4),
+                "share_of_run": round(stats["seconds"] / wall_time, 4) if wall_time else 0,
+                "items_per_sec": round(throughput[name], 2) if name in throughput else None,
+                "peak_rss_growth_mb": round(stats["rss_growth"] / megabyte, 1),
+                "peak_gpu_growth_mb": round(stats["gpu_growth"] / megabyte, 1),
+            } for name, stats in self.stages.items()}
+
+        summary = {
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_time": round(wall_time, 4),
+            "stages": stages,
+            "memory": {
+                # for the whole process, so when running as a worker this includes earlier jobs
+                "peak_rss_mb": round(peak_rss() / megabyte, 1),
+                "peak_gpu_mb": round(peak_gpu_memory() / megabyte, 1),
+            },
+        }
+
+        if status is not None and getattr(status, "enabled", False):
+            summary["status_updates"] = {"logged": status.logged, "sent": status.sent, "failed": status.failed,
+                                         "send_seconds": round(status.send_seconds, 4)}
+
+        return summary
+
+    def finish(self, path, status=None):
+        """
+        Write the summary to a file and print it, and stop profiling
+
+        Does nothing if profiling is disabled.
+
+        :param path:  File to write the JSON summary to
+        :param StatusReporter status:  Reporter to include statistics on sent status updates for, if any
+        :return dict:  Summary, or `None` if profiling is disabled
+        """
+        global _current
+
+        if not self.enabled:
+            return None
+
+        if _current is self:
+            _current = None
+
+        summary = self.summary(status)
+        try:
+            with open(path, "w") as outfile:
+                json.dump(summary, outfile, indent=2)
+        except OSError as e:
+            print(f"Could not write profile to {path}: {e}", file=sys.stderr)
+
+        print(f"\n{'stage':<20s} {'calls':>7s} {'items':>8s} {'seconds':>9s} {'% of run':>8s} {'items/sec':>10s}")
+        for name, stats in summary["stages"].items():
+            per_second = f"{stats['items_per_sec']:,.1f}" if stats["items_per_sec"] is not None else "-"
+            print(f"{name:<20s} {stats['calls']:>7,d} {stats['items']:>8,d} {stats['seconds']:>9.2f} "
+                  f"{stats['share_of_run']:>8.1%} {per_second:>10s}")
+        print(f"Peak memory: {summary['memory']['peak_rss_mb']:,.0f} MB" +
+              (f", {summary['memory']['peak_gpu_mb']:,.0f} MB GPU" if summary["memory"]["peak_gpu_mb"] else "") +
+              f"; profile written to {path}")
+
+        return summary
@@ -0,0 +1,236 @@
+import argparse
+import collections
+import json
+import sys
+import time
+
+import torch
+
+from pathlib import Path
+from transformers import pipeline
+from transformers.pipelines.audio_utils import ffmpeg_read
+from transformers.utils import is_flash_attn_2_available
+from dmi_status import StatusReporter
+from dmi_profile import Profiler, annotate, stage, timed
+
+have_cuda = torch.cuda.is_available()
+dtypes = ["auto", "float16", "bfloat16", "float32"]
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments
+
+    :param list argv:  Arguments to parse; `sys.argv` if `None`
+    """
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--audio-folder", "-i", help="Path to folder containing audio (or video) files", required=True)
+    cli.add_argument("--model", "-m", help="Whisper model from Hugging Face (default openai/whisper-large-v3; e.g. distil-whisper/distil-large-v2 is faster)",
+                     default="openai/whisper-large-v3")
+    cli.add_argument("--batch-size", "-b", help="Number of 30-second chunks to transcribe at once (default 24); lower this if the GPU runs out of memory",
+                     type=int, default=24)
+    cli.add_argument("--chunk-length", help="Length of the chunks long files are split into, in seconds (default 30)", type=int, default=30)
+    cli.add_argument("--device", help="Device to run the model on (default: cuda if available, cpu otherwise)", choices=("auto", "cuda", "cpu"),
+                     default="auto")
+    cli.add_argument("--dtype", help=f"Model precision (options: {', '.join(dtypes)}); 'auto' uses float16 on GPU and float32 on CPU",
+                     choices=dtypes, default="auto")
+    cli.add_argument("--language", "-l", help="Language spoken in the audio; detected if not given", default=None)
+    cli.add_argument("--task", help="Transcribe, or translate to English (default transcribe)", choices=("transcribe", "translate"),
+                     default="transcribe")
+    cli.add_argument("--compare", help="Afterwards, also transcribe the folder with this openai-whisper model (e.g. medium), as the openai_whisper service would, and compare the time taken",
+                     default=None)
+    cli.add_argument("--profile", help="Time each processing stage and write a summary to [dataset name]-profile.json in the output directory (or set DMI_PROFILE=1)",
+                     action="store_true", default=False)
+    cli.add_argument("--output-dir", "-o", help="Output directory where transcripts will be saved", default="data", required=True)
+    cli.add_argument("--dataset-name", "-d", help="Dataset name (to use for output file)", required=True)
+    # These arguments are added by the DMI Service Manager in order for the service to, if desired, provide status updates which will be logged in the DMI Service Manager database.
+    cli.add_argument("--database_key", "-k", default="",
+                     help="DMI Service Manager database key to provide status updates.")
+    cli.add_argument("--dmi_sm_server", "-s", default="",
+                     help="DMI Service Manager server address to provide status updates.")
+    return cli.parse_args(argv)
+
+
+def resolve_device(device, dtype):
+    """
+    Pick the device and model precision
+
+    float16 is fast on GPUs, but very slow (or unsupported) for matrix
+    multiplications on most CPUs, so use float32 there unless told otherwise.
+
+    :param str device:  `auto`, `cuda` or `cpu`
+    :param str dtype:  One of `dtypes`
+    :return tuple:  Resolved device and dtype
+    """
+    if device == "auto":
+        device = "cuda" if have_cuda else "cpu"
+
+    if dtype == "auto":
+        dtype = "float16" if device == "cuda" else "float32"
+
+    return device, dtype
+
+
+def load_pipeline(model_name, device, dtype):
+    """
+    Load a speech recognition pipeline
+
+    Flash attention is used if it is available, which is considerably faster
+    for long batches on recent GPUs.
+
+    :param str model_name:  Model name
+    :param str device:  `cuda` or `cpu`
+    :param str dtype:  Resolved dtype, see `resolve_device`
+    :return:  Pipeline
+    """
+    use_flash_attention = device == "cuda" and dtype != "float32" and is_flash_attn_2_available()
+    return pipeline(
+        "automatic-speech-recognition",
+        model=model_name,
+        torch_dtype=getattr(torch, dtype),
+        device="cuda:0" if device == "cuda" else "cpu",
+        model_kwargs={"attn_implementation": "flash_attention_2"} if use_flash_attention else {},
+    )
+
+
+def decode_files(files, sampling_rate, decoded):
+    """
+    Decode audio files for the pipeline, skipping those that cannot be decoded
+
+    The pipeline would otherwise decode the files itself, and stop at the
+    first file ffmpeg cannot read. Files are decoded one at a time, as the
+    pipeline asks for them, so memory use stays bounded for large folders.
+
+    :param list files:  Audio (or video) files
+    :param int sampling_rate:  Sampling rate the model expects
+    :param collections.deque decoded:  Every file is appended to this, with an error message if it could not be
+    decoded, so the pipeline's results (one per decoded file, in order) can be matched to the files
+    :return:  Generator of pipeline inputs
+    """
+    for path in files:
+        try:
+            with path.open("rb") as infile:
+                audio = ffmpeg_read(infile.read(), sampling_rate)
+        except Exception as e:
+            decoded.append((path, str(e).strip().split("\n")[-1]))
+            continue
+
+        decoded.append((path, None))
+        yield {"raw": audio, "sampling_rate": sampling_rate}
+
+
+def compare_with_openai_whisper(model_name, files, device):
+    """
+    Transcribe files the way the openai_whisper service does, for timing
+
+    :param str model_name:  openai-whisper model name, e.g. `medium`
+    :param list files:  Audio files
+    :param str device:  `cuda` or `cpu`
+    :return tuple:  Model load time and transcription time, in seconds
+    """
+    import whisper
+
+    start = time.time()
+    model = whisper.load_model(model_name, device=device)
+    load_time = time.time() - start
+
+    start = time.time()
+    for index, path in enumerate(files):
+        model.transcribe(str(path), fp16=device == "cuda")
+        print(f"openai-whisper: transcribed {index + 1} of {len(files)} files")
+
+    return load_time, time.time() - start
+
+
+def main(argv=None, models=None):
+    """
+    Transcribe a folder of audio files with the given command line arguments
+
+    :param list argv:  Command line arguments; `sys.argv` if `None`
+    :param models:  `dmi_worker.ModelCache` to keep models loaded between runs, when running as a worker
+    """
+    args = parse_args(argv)
+    status = StatusReporter(args.dmi_sm_server, args.database_key)
+    load = models.get if models is not None else lambda key, loader: loader()
+
+    output_folder = Path(args.output_dir)
+    if not output_folder.exists():
+        status.log(f"Output folder {args.output_dir} not found.")
+        exit(1)
+
+    audio_folder = Path(args.audio_folder)
+    if not audio_folder.is_dir():
+        status.log(f"Audio folder {args.audio_folder} not found.")
+        exit(1)
+
+    device, dtype = resolve_device(args.device, args.dtype)
+    if device == "cuda" and not have_cuda:
+        status.log("CUDA is not available; use --device cpu or --device auto.")
+        exit(1)
+
+    status.log(f"Setting up model ({args.model}, {dtype} on {device})...")
+    start = time.time()
+    pipe = load(("insanely_fast_whisper", args.model, device, dtype), lambda: load_pipeline(args.model, device, dtype))
+    load_time = time.time() - start
+
+    files = sorted([path for path in audio_folder.glob("*") if path.is_file()])
+    generate_kwargs = {"task": args.task, **({"language": args.language} if args.language else {})}
+
+    output_path = output_folder.joinpath(args.dataset_name + ".ndjson")
+    done = 0
+    failed = 0
+    start = time.time()
+    profiler = Profiler(args.profile)
+    status.log(f"Transcribing {len(files)} files...", num_records=0)
+    with output_path.open("w") as outfile:
+        def write_failed():
+            # files that could not be decoded get an error line where their transcript would be
+            nonlocal failed
+            while decoded and decoded[0][1] is not None:
+                path, error = decoded.popleft()
+                print(f"Could not decode {path.name}, skipping ({error})", file=sys.stderr)
+                outfile.write(json.dumps({path.name: {"error": error}}) + "\n")
+                failed += 1
+
+        # long files are split into chunks, and chunks of several files are
+        # transcribed in one batch; results come in per file, in order
+        decoded = collections.deque()
+        results = pipe(decode_files(files, pipe.feature_extractor.sampling_rate, decoded), chunk_length_s=args.chunk_length,
+                       batch_size=max(1, args.batch_size), return_timestamps=True, generate_kwargs=generate_kwargs)
+        # the pipeline decodes, chunks and transcribes files as results are requested, so this is all one stage
+        for result in timed("transcribe", results):
+            with stage("write", items=1):
+                write_failed()
+                path, error = decoded.popleft()
+                outfile.write(json.dumps({path.name: result}) + "\n")
+                outfile.flush()
+
+            done += 1
+            with stage("status"):
+                status.log(annotate(f"Transcribed {done} of {len(files)} files"), num_records=done)
+
+        write_failed()
+
+    elapsed = time.time() - start
+    if failed:
+        print(f"{failed} files could not be decoded")
+    profiler.finish(output_folder.joinpath(f"{args.dataset_name}-profile.json"), status)
+    timings = [(f"{args.model} ({dtype}, batch size {args.batch_size})", load_time, elapsed)]
+
+    if args.compare:
+        status.log(f"Transcribing {len(files)} files with openai-whisper {args.compare} for comparison...", num_records=done)
+        try:
+            timings.append((f"openai-whisper {args.compare}", *compare_with_openai_whisper(args.compare, files, device)))
+        except ImportError:
+            print("openai-whisper is not installed, cannot compare (pip install openai-whisper)", file=sys.stderr)
+
+    print(f"\n{'model':<50s} {'load (s)':>9s} {'transcribe (s)':>15s} {'files/sec':>10s}")
+    for model_name, model_load_time, transcribe_time in timings:
+        print(f"{model_name:<50s} {model_load_time:>9.1f} {transcribe_time:>15.1f} {len(files) / transcribe_time if transcribe_time else 0:>10.2f}")
+
+    if len(timings) > 1 and timings[0][2]:
+        print(f"\n{timings[1][2] / timings[0][2]:.1f}x the throughput of openai-whisper {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,25 @@
 import argparse
+import hashlib
 import importlib
 import os
+import numpy as np
 import torch
-import requests
 import torchvision
 import clip
 from PIL import Image
+from dmi_status import StatusReporter
+from dmi_profile import Profiler, annotate, stage, timed
 from pathlib import Path
 import json
-from urllib.parse import quote_plus
-import requests
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
 
-def parse_args():
+def parse_args(argv=None):
     """
     Parse command line arguments
+
+    :param list argv:  Arguments to parse; `sys.argv` if `None`
     """
     cli = argparse.ArgumentParser()
     cli.add_argument("--available_models", "-a", default=False, help="Get available models.", action="store_true")
@@ -25,21 +28,35 @@ def parse_args():
     cli.add_argument("--output_dir", "-o", default="", help="Directory to store JSON results.")
     cli.add_argument("--categories", "-c", default="", help="Categories to classify image (comma seperated list).")
     cli.add_argument("--images", "-i", nargs="+", type=str, help="Image(s) to classify.")
+    cli.add_argument("--ndjson", "-j", default="",
+                     help="Write all results to this NDJSON file in the output directory, instead of one JSON file per image.")
+    cli.add_argument("--top_k", "-t", default=0, type=int,
+                     help="Only keep this many labels per image (default 0, i.e. keep all labels).")
+    cli.add_argument("--threshold", default=0.0, type=float,
+                     help="Only keep labels with at least this probability (default 0, i.e. keep all labels).")
+    cli.add_argument("--scores_file", default="",
+                     help="Also store the full image x category probability matrix as a float16 .npy file with this name in the output directory.")
+    cli.add_argument("--embeddings_dir", "-e", default="",
+                     help="Directory to store image embeddings in, so the images can later be searched with --query.")
+    cli.add_argument("--query", "-q", nargs="+", type=str,
+                     help="Text query (or queries) to search the image embeddings in --embeddings_dir for.")
+    cli.add_argument("--top_n", "-n", default=10, type=int, help="Number of images to return per query (default 10).")
+    cli.add_argument("--batch_size", "-b", default=1, type=int, help="Number of images to encode at once (default 1).")
+    cli.add_argument("--workers", "-w", default=0, type=int,
+                     help="Number of background processes decoding and preprocessing images (default 0, i.e. decode in the main process).")
+    cli.add_argument("--cache_dir", default=os.path.expanduser("~/.cache/dmi_clip"),
+                     help="Directory to cache encoded category prompts in, so repeat runs can skip text encoding.")
+    cli.add_argument("--no_cache", default=False, help="Do not read or write the category prompt cache.",
+                     action="store_true")
+    cli.add_argument("--profile", default=False, action="store_true",
+                     help="Time each processing stage and write a summary to clip_profile.json in the output directory (or set DMI_PROFILE=1).")
     # These arguments are added by the DMI Service Manager in order for the service to, if desired, provide status updates which will be logged in the DMI Service Manager database.
     cli.add_argument("--database_key", "-k", default="",
                      help="DMI Service Manager database key to provide status updates.")
     cli.add_argument("--dmi_sm_server", "-s", default="",
                      help="DMI Service Manager server address to provide status updates.")
 
-    return cli.parse_args()
-
-def log(message, server=None, db_key=None, num_records=None):
-    print(message)
-    if server and db_key:
-        try:
-            requests.post(f"{server}/status_update/?key={db_key}&status=running&message={quote_plus(message)}{'&num_records=' + str(num_records) if num_records else ''}")
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to log status update: {e}")
+    return cli.parse_args(argv)
 
 
 def collect_image_categories(dataset_name):
@@ -94,14 +111,19 @@ def predict_image_category_probabilities(model, preprocess, image_path, text_lis
     return probs
 
 
-def get_similarity(query, image_path):
+def get_similarity(model, preprocess, query, image_path):
     """
     This calculates the similarity of a text query to an image.
 
     It uses the CLIP model to encode the text and image, then calculates the dot product of the two embeddings. This can
     be used to show how similar the text query is to the image (in terms of the CLIP model's understanding of the text/image).
 
+    To compare many queries to the same images, store the image embeddings with `--embeddings_dir` and use
+    `search_embeddings` instead, which does not re-encode the images.
+
     TODO: How do we come up with a threshold to determine if the text is similar to the image?
+    :param model:  Loaded CLIP model
+    :param preprocess:  CLIP image preprocessor
     :param query:
     :param image_path:
     :return:
@@ -116,18 +138,76 @@ def get_similarity(query, image_path):
     return query_embeddings @ image_features.T
 
 
-def top_labels(model, preprocess, classes, image_path):
+def class_prompts(classes):
+    return [f"a photo of a {c}" for c in classes]
+
+
+def encode_classes(model, model_name, classes, cache_dir=None):
+    """
+    Encode the category prompts for a list of classes
+
+    The result is a normalized matrix with one row per class, which can be
+    reused for every image in a run. If a cache directory is given, the matrix
+    is stored there keyed by model name and prompt list, so that subsequent
+    runs with the same model and categories skip text encoding entirely.
+
+    :param model:  Loaded CLIP model
+    :param str model_name:  Name of the model, used as part of the cache key
+    :param list classes:  Class names
+    :param cache_dir:  Directory to cache encoded prompts in, or `None`
+    :return torch.Tensor:  Normalized text features, shape (classes, dim)
+    """
+    prompts = class_prompts(classes)
+    cache_file = None
+    if cache_dir:
+        cache_key = hashlib.sha256(json.dumps([model_name, prompts]).encode("utf-8")).hexdigest()
+        cache_file = Path(cache_dir).joinpath(f"{cache_key}.pt")
+        if cache_file.exists():
+            try:
+                # the cache may have been written on a different device, so match this model's dtype
+                return torch.load(cache_file, map_location=device).to(model.dtype)
+            except (OSError, RuntimeError) as e:
+                print(f"Could not read cached category prompts from {cache_file}, re-encoding: {e}")
+
+    text_inputs = clip.tokenize(prompts).to(device)
+    with torch.no_grad():
+        text_features = model.encode_text(text_inputs)
+    text_features /= text_features.norm(dim=-1, keepdim=True)
+
+    if cache_file:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first so concurrent runs never see a partial cache file
+            temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            torch.save(text_features.cpu(), temp_file)
+            temp_file.replace(cache_file)
+        except OSError as e:
+            print(f"Could not cache category prompts in {cache_dir}: {e}")
+
+    return text_features
+
+
+def top_labels(model, preprocess, classes, image_path, text_features=None):
+    """
+    Rank all classes by similarity to an image
+
+    :param model:  Loaded CLIP model
+    :param preprocess:  CLIP image preprocessor
+    :param list classes:  Class names
+    :param image_path:  Path to image
+    :param text_features:  Normalized class prompt features from `encode_classes`; encoded on the fly if not given
+    :return list:  (class, probability) tuples, most likely first
+    """
     image_input = preprocess(Image.open(image_path)).unsqueeze(0).to(device)
-    text_inputs = torch.cat([clip.tokenize(f"a photo of a {c}") for c in classes]).to(device)
+    if text_features is None:
+        text_features = encode_classes(model, None, classes)
 
     # Calculate features
     with torch.no_grad():
         image_features = model.encode_image(image_input)
-        text_features = model.encode_text(text_inputs)
 
     # Pick the top 5 most similar labels for the image
     image_features /= image_features.norm(dim=-1, keepdim=True)
-    text_features /= text_features.norm(dim=-1, keepdim=True)
     similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1)
     values, indices = similarity[0].topk(len(classes))
 
@@ -143,12 +223,229 @@ def top_labels(model, preprocess, classes, image_path):
     return predictions
 
 
-if __name__ == "__main__":
-    args = parse_args()
+class ImageDataset(torch.utils.data.Dataset):
+    """
+    Decode and preprocess images, so this can happen in DataLoader worker processes
+
+    Items are (index, image tensor, error) tuples; the tensor is `None` and the
+    error is set if the image could not be read.
+    """
+    def __init__(self, image_paths, preprocess):
+        self.image_paths = image_paths
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        image = Path(self.image_paths[index])
+        if not image.is_file():
+            return index, None, f"Invalid image path {image}"
+
+        try:
+            with Image.open(image) as image_obj:
+                return index, self.preprocess(image_obj), None
+        except (OSError, ValueError) as e:
+            return index, None, f"Unable to read image {image}: {e}"
+
+
+def collate_images(items):
+    """
+    Stack the readable images in a batch, and keep track of the others
+
+    :param list items:  Items from `ImageDataset`
+    :return tuple:  List of indexes, stacked image tensor (or `None`), list of (index, error) tuples
+    """
+    valid = [(index, image) for index, image, error in items if error is None]
+    errors = [(index, error) for index, image, error in items if error is not None]
+    if not valid:
+        return [], None, errors
+
+    return [index for index, image in valid], torch.stack([image for index, image in valid]), errors
+
+
+def encode_images(model, images):
+    """
+    Encode a batch of preprocessed images
+
+    :param model:  Loaded CLIP model
+    :param torch.Tensor images:  Stacked preprocessed images
+    :return torch.Tensor:  Normalized image features, shape (images, dim)
+    """
+    with torch.no_grad():
+        image_features = model.encode_image(images.to(device))
+
+    image_features /= image_features.norm(dim=-1, keepdim=True)
+    return image_features
+
+
+def class_probabilities(image_features, text_features):
+    """
+    Calculate class probabilities for a batch of images
+
+    Similarities for the whole batch are calculated with a single matrix
+    multiplication.
+
+    :param torch.Tensor image_features:  Normalized image features from `encode_images`
+    :param torch.Tensor text_features:  Normalized class prompt features from `encode_classes`
+    :return torch.Tensor:  Probabilities, shape (images, classes)
+    """
+    return (100.0 * image_features @ text_features.T).softmax(dim=-1)
+
+
+def top_labels_batch(classes, probabilities, top_k=None, threshold=None):
+    """
+    Rank classes by probability for a batch of images
+
+    :param list classes:  Class names
+    :param torch.Tensor probabilities:  Class probabilities from `class_probabilities`
+    :param int top_k:  Number of labels to return per image; all if `None`
+    :param float threshold:  Only return labels with at least this probability
+    :return list:  For each image, a list of (class, probability) tuples, most likely first
+    """
+    values, indices = probabilities.topk(min(top_k or len(classes), len(classes)), dim=-1)
+
+    return [[(classes[index], value) for value, index in zip(image_values, image_indices)
+             if not threshold or value >= threshold]
+            for image_values, image_indices in zip(values.tolist(), indices.tolist())]
+
+
+def create_embedding_store(store_dir, model_name, image_paths, dimensions):
+    """
+    Create an on-disk store for image embeddings
+
+    The store consists of a memory-mapped float16 matrix (`embeddings.npy`)
+    with one row per image, and an index (`index.json`) with the model name
+    and the file name for each row. Rows for images that could not be read
+    have a `null` file name.
+
+    :param store_dir:  Directory to create the store in
+    :param str model_name:  CLIP model used to create the embeddings
+    :param list image_paths:  Images that will be stored, in row order
+    :param int dimensions:  Embedding size
+    :return tuple:  Writable memmap, and the index as a dict
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    embeddings = np.lib.format.open_memmap(store_dir.joinpath("embeddings.npy"), mode="w+", dtype=np.float16,
+                                           shape=(len(image_paths), dimensions))
+    index = {"model": model_name, "filenames": [Path(image_path).name for image_path in image_paths]}
+
+    return embeddings, index
+
+
+def save_embedding_index(store_dir, index):
+    with Path(store_dir).joinpath("index.json").open("w") as outfile:
+        json.dump(index, outfile)
+
+
+def load_embedding_store(store_dir):
+    """
+    Open an image embedding store created with `create_embedding_store`
+
+    :param store_dir:  Directory containing the store
+    :return tuple:  Read-only memmap, and the index as a dict
+    """
+    store_dir = Path(store_dir)
+    with store_dir.joinpath("index.json").open() as infile:
+        index = json.load(infile)
+
+    return np.load(store_dir.joinpath("embeddings.npy"), mmap_mode="r"), index
+
+
+def encode_queries(model, queries):
+    """
+    Encode text queries
+
+    :param model:  Loaded CLIP model
+    :param list queries:  Text queries
+    :return np.ndarray:  Normalized query features, shape (queries, dim)
+    """
+    query_tokens = clip.tokenize(queries, truncate=True).to(device)
+    with torch.no_grad():
+        query_features = model.encode_text(query_tokens)
+
+    query_features /= query_features.norm(dim=-1, keepdim=True)
+    return query_features.float().cpu().numpy()
+
+
+def search_embeddings(embeddings, index, query_features, queries, top_n=10):
+    """
+    Find the images most similar to each of a number of text queries
+
+    All queries are compared to all stored images with a single matrix
+    multiplication, so no images need to be re-encoded.
+
+    :param np.ndarray embeddings:  Image embeddings from `load_embedding_store`
+    :param dict index:  Embedding store index
+    :param np.ndarray query_features:  Normalized query features from `encode_queries`
+    :param list queries:  Text queries, in the same order as `query_features`
+    :param int top_n:  Number of images to return per query
+    :return dict:  Query -> list of (filename, cosine similarity) tuples, most similar first
+    """
+    similarity = np.asarray(embeddings, dtype=np.float32) @ query_features.T
+    similarity[np.array([filename is None for filename in index["filenames"]], dtype=bool)] = -np.inf
+
+    top_n = min(top_n, similarity.shape[0])
+    results = {}
+    for i, query in enumerate(queries):
+        scores = similarity[:, i]
+        top = np.argpartition(-scores, top_n - 1)[:top_n] if top_n else []
+        top = sorted(top, key=lambda row: scores[row], reverse=True)
+        results[query] = [(index["filenames"][row], float(scores[row])) for row in top if np.isfinite(scores[row])]
+
+    return results
+
+
+def main(argv=None, models=None):
+    """
+    Run CLIP with the given command line arguments
+
+    :param list argv:  Command line arguments; `sys.argv` if `None`
+    :param models:  `dmi_worker.ModelCache` to keep models loaded between runs, when running as a worker
+    """
+    args = parse_args(argv)
+    status = StatusReporter(args.dmi_sm_server, args.database_key)
+    load = models.get if models is not None else lambda key, loader: loader()
     if args.available_models:
         print(get_available_models())
         exit(0)
 
+    output_dir = Path(args.output_dir) if args.output_dir else Path(".")
+
+    if args.query:
+        # search previously stored image embeddings; no images need to be encoded
+        if not args.embeddings_dir:
+            print("Must specify --embeddings_dir to search with --query.")
+            exit(1)
+
+        try:
+            embeddings, index = load_embedding_store(args.embeddings_dir)
+        except (OSError, ValueError) as e:
+            print(f"Unable to load image embeddings from {args.embeddings_dir}: {e}")
+            exit(1)
+
+        if args.model and args.model != index["model"]:
+            print(f"Embeddings in {args.embeddings_dir} were created with model {index['model']}, not {args.model}.")
+            exit(1)
+
+        try:
+            model, preprocess = load(("clip", index["model"]), lambda: load_model(index["model"]))
+        except ValueError as e:
+            print(e)
+            exit(1)
+
+        results = search_embeddings(embeddings, index, encode_queries(model, args.query), args.query, args.top_n)
+        for query, matches in results.items():
+            print(f"\nTop images for {query}:")
+            for filename, score in matches[:5]:
+                print(f"{filename:>32s}: {score:.4f}")
+
+        with open(output_dir.joinpath("query_results.json"), "w") as out_file:
+            out_file.write(json.dumps(results))
+
+        exit(0)
+
     if args.dataset:
         try:
             classes = collect_image_categories(args.dataset)
@@ -160,6 +457,9 @@ if __name__ == "__main__":
             exit(1)
     elif args.categories:
         classes = args.categories.split(",")
+    elif args.embeddings_dir:
+        # only store embeddings, do not classify
+        classes = None
     else:
         print("Must specify either --dataset or --categories.")
         exit(1)
@@ -173,26 +473,97 @@ if __name__ == "__main__":
         exit(1)
 
     try:
-        model, preprocess = load_model(args.model)
+        model, preprocess = load(("clip", args.model), lambda: load_model(args.model))
     except ValueError as e:
         print(e)
         exit(1)
 
-    output_dir = Path(args.output_dir) if args.output_dir else Path(".")
-
-    for i, image_path in enumerate(args.images):
-        image = Path(image_path)
-        if image.is_file():
-            prediction = top_labels(model, preprocess, classes, image_path)
-            results = {"filename": image.name,
-                       "predictions": prediction}
-        else:
-            error = f"Invalid image path {image}"
+    # the class prompts are the same for every image, so encode them only once
+    if classes:
+        text_features = encode_classes(model, args.model, classes, cache_dir=None if args.no_cache else args.cache_dir)
+
+    if args.embeddings_dir:
+        embeddings, embedding_index = create_embedding_store(args.embeddings_dir, args.model, args.images,
+                                                             model.visual.output_dim)
+
+    if classes and args.ndjson:
+        # one buffered output file for all images, rather than one file per image
+        ndjson_file = output_dir.joinpath(args.ndjson).open("w", buffering=1024 * 1024)
+
+    if classes and args.scores_file:
+        scores_path = output_dir.joinpath(args.scores_file).with_suffix(".npy")
+        scores = np.lib.format.open_memmap(scores_path, mode="w+", dtype=np.float16,
+                                           shape=(len(args.images), len(classes)))
+        # columns of the score matrix are in category order, rows in image order
+        with scores_path.with_suffix(".json").open("w") as outfile:
+            json.dump({"classes": classes, "filenames": [Path(image).name for image in args.images]}, outfile)
+
+    # decoding and preprocessing happens in the DataLoader (in background processes if --workers is set) so
+    # that it overlaps with inference, and images are encoded in batches
+    loader = torch.utils.data.DataLoader(ImageDataset(args.images, preprocess), batch_size=max(1, args.batch_size),
+                                         num_workers=max(0, args.workers), collate_fn=collate_images,
+                                         pin_memory=device == "cuda")
+
+    profiler = Profiler(args.profile)
+    done = 0
+    for indexes, images, errors in timed("decode", loader, lambda batch: len(batch[0]) + len(batch[2])):
+        results = {}
+        for index, error in errors:
             print(error)
-            results = {"filename": image.name,
-                       "error": error}
+            results[index] = {"filename": Path(args.images[index]).name,
+                              "error": error}
+            if args.embeddings_dir:
+                embedding_index["filenames"][index] = None
 
-        with open(output_dir.joinpath(image.with_suffix(".json").name), "w") as out_file:
-            out_file.write(json.dumps(results))
+        if indexes:
+            with stage("model", items=len(indexes), sync=True):
+                image_features = encode_images(model, images)
+
+            if args.embeddings_dir:
+                with stage("write"):
+                    embeddings[indexes] = image_features.cpu().numpy().astype(np.float16)
+
+            if classes:
+                with stage("classify", items=len(indexes), sync=True):
+                    probabilities = class_probabilities(image_features, text_features)
+                    predictions_batch = top_labels_batch(classes, probabilities, args.top_k, args.threshold)
+
+                if args.scores_file:
+                    with stage("write"):
+                        scores[indexes] = probabilities.cpu().numpy().astype(np.float16)
+
+                for index, predictions in zip(indexes, predictions_batch):
+                    print(f"\nTop predictions for {Path(args.images[index]).name}:")
+                    for label, value in predictions[:5]:
+                        print(f"{label:>16s}: {100 * value:.2f}%")
+
+                    results[index] = {"filename": Path(args.images[index]).name,
+                                      "predictions": predictions}
+
+        with stage("write", items=len(indexes) + len(errors)):
+            if classes and args.ndjson:
+                ndjson_file.write("".join(json.dumps(results[index]) + "\n" for index in sorted(results)))
+            elif classes:
+                for index in sorted(results):
+                    with open(output_dir.joinpath(Path(args.images[index]).with_suffix(".json").name), "w") as out_file:
+                        out_file.write(json.dumps(results[index]))
 
-        log(f"Processed {i + 1} images", args.dmi_sm_server, args.database_key, num_records=i + 1)
+        done += len(indexes) + len(errors)
+        with stage("status"):
+            status.log(annotate(f"Processed {done} images"), num_records=done)
+
+    if classes and args.ndjson:
+        ndjson_file.close()
+
+    if classes and args.scores_file:
+        scores.flush()
+
+    if args.embeddings_dir:
+        embeddings.flush()
+        save_embedding_index(args.embeddings_dir, embedding_index)
+
+    profiler.finish(output_dir.joinpath("clip_profile.json"), status)
+
+
+if __name__ == "__main__":
+    main()
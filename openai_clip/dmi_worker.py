@@ -0,0 +1,315 @@
+"""
+Warm-model worker for DMI services
+
+Running a service via `docker exec` starts a new Python process for every job,
+which then imports torch and loads the model weights from disk again. This can
+take from tens of seconds to minutes, which often dwarfs the job itself. The
+worker is a long-lived process that keeps loaded models in memory and runs
+jobs from a queue, one at a time, with the same command line arguments as the
+service's own interface script.
+
+Start the worker (e.g. from `docker-entrypoint.sh`) with:
+
+    python3 dmi_worker.py serve --service interface --port 4010
+    python3 dmi_worker.py serve --service interface --socket /tmp/dmi_worker.sock
+
+Then submit jobs, with the arguments you would otherwise pass to the service:
+
+    python3 dmi_worker.py submit --port 4010 -- --image-folder data/images ...
+
+or POST them as JSON (`{"args": [...]}`) to `/jobs`, and poll `/jobs/<id>`.
+
+The service module must provide a `main(argv=None, models=None)` function;
+`models` is a `ModelCache`. Models that have not been used for a while, or
+the least recently used models when memory runs low, are evicted.
+
+This file is identical in every service folder, since each service is built
+from its own folder as Docker context.
+"""
+import argparse
+import gc
+import http.client
+import http.server
+import importlib
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+
+def available_memory_fraction():
+    """
+    Get the fraction of memory that is still available
+
+    Looks at system memory and, if CUDA is in use, GPU memory, and returns the
+    lowest of the two.
+
+    :return float:  Available fraction, between 0 and 1; 1 if unknown
+    """
+    fractions = []
+    try:
+        with open("/proc/meminfo") as infile:
+            meminfo = {line.split(":")[0]: int(line.split()[1]) for line in infile if len(line.split()) >= 2}
+        fractions.append(meminfo["MemAvailable"] / meminfo["MemTotal"])
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        pass
+
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        free, total = torch.cuda.mem_get_info()
+        fractions.append(free / total)
+
+    return min(fractions) if fractions else 1.0
+
+
+class ModelCache:
+    """
+    Keep loaded models in memory between jobs
+
+    Models are identified by a hashable key, e.g. the model name and dtype.
+    """
+    def __init__(self, max_idle=None, min_available=None):
+        """
+        :param float max_idle:  Evict models not used for this many seconds; defaults to `DMI_WORKER_MAX_IDLE` or 1800
+        :param float min_available:  Evict least recently used models before loading another while less than this
+        fraction of (GPU) memory is available; defaults to `DMI_WORKER_MIN_AVAILABLE` or 0.2
+        """
+        self.max_idle = float(os.environ.get("DMI_WORKER_MAX_IDLE", 1800) if max_idle is None else max_idle)
+        self.min_available = float(os.environ.get("DMI_WORKER_MIN_AVAILABLE", 0.2) if min_available is None else min_available)
+        self.models = OrderedDict()
+        self.last_used = {}
+
+    def get(self, key, loader):
+        """
+        Get a model, loading it if it is not in memory yet
+
+        :param key:  Model identifier
+        :param callable loader:  Function without arguments that loads the model
+        :return:  Whatever `loader` returns
+        """
+        if key in self.models:
+            self.models.move_to_end(key)
+        else:
+            while self.models and available_memory_fraction() < self.min_available:
+                self.evict(next(iter(self.models)), "memory pressure")
+
+            self.models[key] = loader()
+
+        self.last_used[key] = time.monotonic()
+        return self.models[key]
+
+    def evict(self, key, reason=""):
+        print(f"Evicting model {key}{' (' + reason + ')' if reason else ''}")
+        del self.models[key]
+        del self.last_used[key]
+        gc.collect()
+
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for key in [key for key, last_used in self.last_used.items() if now - last_used > self.max_idle]:
+            self.evict(key, "idle")
+
+
+class Worker:
+    """
+    Run queued jobs, one at a time, with a service's `main()` function
+    """
+    def __init__(self, service, models=None, max_history=None):
+        """
+        :param service:  Module with the service's `main()` function
+        :param ModelCache models:  Model cache to pass to the service; a new one if not given
+        :param int max_history:  Number of finished jobs to keep the status of; defaults to `DMI_WORKER_JOB_HISTORY` or
+        100
+        """
+        self.service = service
+        self.models = models if models is not None else ModelCache()
+        self.max_history = int(os.environ.get("DMI_WORKER_JOB_HISTORY", 100) if max_history is None else max_history)
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def submit(self, argv):
+        with self.lock:
+            job_id = str(next(self.ids))
+            self.jobs[job_id] = {"id": job_id, "args": argv, "status": "queued", "exit_code": None, "error": None,
+                                 "done": threading.Event()}
+
+        self.queue.put(job_id)
+        return job_id
+
+    def status(self, job_id):
+        return self.describe(self.jobs.get(job_id))
+
+    def describe(self, job):
+        return {key: value for key, value in job.items() if key != "done"} if job else None
+
+    def prune(self):
+        """
+        Forget the oldest finished jobs, so a long-lived worker does not keep
+        every job it ever ran
+        """
+        with self.lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job["done"].is_set()]
+            for job_id in finished[:max(0, len(finished) - self.max_history)]:
+                del self.jobs[job_id]
+
+    def run(self):
+        while True:
+            try:
+                job_id = self.queue.get(timeout=60)
+            except queue.Empty:
+                self.models.evict_idle()
+                continue
+
+            job = self.jobs[job_id]
+            job["status"] = "running"
+            print(f"Running job {job_id}: {' '.join(job['args'])}")
+            try:
+                self.service.main(job["args"], models=self.models)
+                job["exit_code"] = 0
+            except SystemExit as e:
+                # the service scripts call exit() on invalid input
+                job["exit_code"] = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+                if job["exit_code"] and not isinstance(e.code, int):
+                    job["error"] = str(e.code)
+            except Exception as e:
+                traceback.print_exc()
+                job["exit_code"] = 1
+                job["error"] = f"{type(e).__name__}: {e}"
+
+            # send the job's final status updates now, rather than when the worker exits
+            dmi_status = sys.modules.get("dmi_status")
+            if dmi_status is not None:
+                dmi_status.close_all()
+
+            job["status"] = "finished" if job["exit_code"] == 0 else "failed"
+            job["done"].set()
+            self.prune()
+            self.models.evict_idle()
+
+
+class WorkerRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP interface to the worker
+
+    - `POST /jobs` with `{"args": [...]}` queues a job; add `?wait=1` to only
+      respond once it has finished
+    - `GET /jobs/<id>` returns the status of a job
+    """
+    def do_POST(self):
+        path, _, query = self.path.partition("?")
+        if path.rstrip("/") != "/jobs":
+            return self.respond(404, {"error": "Not found"})
+
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            argv = [str(arg) for arg in payload["args"]]
+        except (ValueError, KeyError, TypeError):
+            return self.respond(400, {"error": "Expected a JSON object with an 'args' list"})
+
+        job_id = self.server.worker.submit(argv)
+        if "wait=1" in query.split("&"):
+            # keep a reference, since the job may be pruned from the history by the time this thread gets to respond
+            job = self.server.worker.jobs[job_id]
+            job["done"].wait()
+            return self.respond(200, self.server.worker.describe(job))
+
+        self.respond(202, self.server.worker.status(job_id))
+
+    def do_GET(self):
+        if not self.path.startswith("/jobs/"):
+            return self.respond(404, {"error": "Not found"})
+
+        job = self.server.worker.status(self.path[len("/jobs/"):].strip("/"))
+        self.respond(200 if job else 404, job or {"error": "Unknown job"})
+
+    def respond(self, code, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # client_address is not a (host, port) tuple for Unix sockets
+        pass
+
+
+class WorkerHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class WorkerUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def serve(args):
+    sys.path.insert(0, os.getcwd())
+    worker = Worker(importlib.import_module(args.service))
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = WorkerUnixHTTPServer(args.socket, WorkerRequestHandler)
+        address = args.socket
+    else:
+        server = WorkerHTTPServer((args.host, args.port), WorkerRequestHandler)
+        address = f"http://{args.host}:{args.port}"
+
+    server.worker = worker
+    threading.Thread(target=server.serve_forever, name="dmi-worker-http", daemon=True).start()
+    print(f"Worker for {args.service} listening on {address}")
+    worker.run()
+
+
+def submit(args):
+    connection = UnixHTTPConnection(args.socket) if args.socket else http.client.HTTPConnection(args.host, args.port)
+    connection.request("POST", "/jobs?wait=1", body=json.dumps({"args": args.job_args}),
+                       headers={"Content-Type": "application/json"})
+    job = json.loads(connection.getresponse().read())
+    print(json.dumps(job))
+    exit(0 if job.get("status") == "finished" else job.get("exit_code") or 1)
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser()
+    cli.add_argument("action", choices=("serve", "submit"), help="Start a worker, or submit a job and wait for it")
+    cli.add_argument("--service", default="interface", help="Module with the service's main() function")
+    # defaults are those the entrypoints start the worker with, so `submit` connects to it without further arguments
+    cli.add_argument("--host", default=os.environ.get("DMI_WORKER_HOST", "127.0.0.1"),
+                     help="Host to listen on or connect to (default: DMI_WORKER_HOST or 127.0.0.1)")
+    cli.add_argument("--port", default=int(os.environ.get("DMI_WORKER_PORT", 4010)), type=int,
+                     help="Port to listen on or connect to (default: DMI_WORKER_PORT or 4010)")
+    cli.add_argument("--socket", default=os.environ.get("DMI_WORKER_SOCKET", ""),
+                     help="Unix socket to listen on or connect to, instead of host and port (default: DMI_WORKER_SOCKET, if set)")
+
+    # everything after -- is passed on to the service as is
+    argv = sys.argv[1:]
+    job_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = cli.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+    args.job_args = job_args
+
+    serve(args) if args.action == "serve" else submit(args)
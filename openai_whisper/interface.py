@@ -0,0 +1,300 @@
+import argparse
+import collections
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import whisper
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from dmi_status import StatusReporter
+from dmi_profile import Profiler, annotate, stage, timed
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments
+
+    :param list argv:  Arguments to parse; `sys.argv` if `None`
+    """
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--audio-folder", "-i", help="Path to folder containing audio (or video) files", required=True)
+    cli.add_argument("--model", "-m", help=f"Whisper model (options: {', '.join(whisper.available_models())}; default medium)",
+                     choices=whisper.available_models(), default="medium")
+    cli.add_argument("--language", "-l", help="Language spoken in the audio; detected per file if not given", default=None)
+    cli.add_argument("--task", help="Transcribe, or translate to English (default transcribe)", choices=("transcribe", "translate"),
+                     default="transcribe")
+    cli.add_argument("--workers", "-w", help="Number of processes decoding audio ahead of the model (default: number of CPU cores)",
+                     type=int, default=os.cpu_count() or 1)
+    cli.add_argument("--cache-dir", help="Folder to cache decoded audio in, per file content, so files transcribed before (with any model) do not need to be decoded again",
+                     default=os.path.expanduser("~/.cache/dmi_whisper_audio"))
+    cli.add_argument("--cache-size", help="Maximum size of the audio cache in GB; least recently used files are removed when it grows larger (default 20)",
+                     type=float, default=20)
+    cli.add_argument("--no-cache", help="Do not read or write the audio cache", action="store_true", default=False)
+    cli.add_argument("--profile", help="Time each processing stage and write a summary to [dataset name]-profile.json in the output directory (or set DMI_PROFILE=1)",
+                     action="store_true", default=False)
+    cli.add_argument("--output-dir", "-o", help="Output directory where transcripts will be saved", default="data", required=True)
+    cli.add_argument("--dataset-name", "-d", help="Dataset name (to use for output file)", required=True)
+    # These arguments are added by the DMI Service Manager in order for the service to, if desired, provide status updates which will be logged in the DMI Service Manager database.
+    cli.add_argument("--database_key", "-k", default="",
+                     help="DMI Service Manager database key to provide status updates.")
+    cli.add_argument("--dmi_sm_server", "-s", default="",
+                     help="DMI Service Manager server address to provide status updates.")
+    return cli.parse_args(argv)
+
+
+def file_hash(path):
+    """
+    Hash a file's contents
+
+    :param Path path:  File
+    :return str:  Hash
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        while chunk := infile.read(1024 * 1024):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class AudioCache:
+    """
+    Cache of decoded audio, per file content
+
+    Datasets are often transcribed more than once, e.g. first with a small
+    model and then with a larger one, and decoding with ffmpeg is often the
+    slowest part after the model itself. Decoded 16 kHz samples are stored as
+    `.npy` files named after the hash of the original file, and memory-mapped
+    when read, so they are the same for all models.
+
+    When the cache grows larger than `max_size`, the least recently used files
+    are removed; this is checked while transcribing, not only afterwards, so a
+    large folder of new files does not fill up the disk first.
+    """
+    def __init__(self, path, max_size):
+        """
+        :param str path:  Cache folder; created if it does not exist
+        :param int max_size:  Maximum size in bytes
+        """
+        self.path = Path(path)
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def file_for(self, digest):
+        return self.path.joinpath(f"{digest}.npy")
+
+    def get(self, digest):
+        """
+        Get decoded audio from the cache
+
+        :param str digest:  File hash
+        :return:  Samples, as a memory-mapped array, or `None` if not cached
+        """
+        cache_file = self.file_for(digest)
+        try:
+            # copy-on-write, since torch does not like read-only arrays
+            samples = np.load(cache_file, mmap_mode="c")
+            os.utime(cache_file)
+            return samples
+        except (OSError, ValueError):
+            return None
+
+    def contains(self, digest):
+        cache_file = self.file_for(digest)
+        if not cache_file.exists():
+            return False
+
+        # mark as recently used
+        os.utime(cache_file)
+        return True
+
+    def put(self, digest, samples):
+        """
+        Store decoded audio in the cache
+
+        :param str digest:  File hash
+        :param samples:  Samples
+        """
+        cache_file = self.file_for(digest)
+        temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with temp_file.open("wb") as outfile:
+            np.save(outfile, samples)
+
+        # other processes never see a partially written file
+        os.replace(temp_file, cache_file)
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used files until the cache fits its maximum size
+
+        :param keep:  Hashes of files that are still to be read, and should not be removed
+        :return int:  Number of files removed
+        """
+        files = []
+        for cache_file in self.path.glob("*.npy"):
+            if cache_file.stem in keep:
+                continue
+
+            try:
+                stat = cache_file.stat()
+                files.append((stat.st_mtime, stat.st_size, cache_file))
+            except FileNotFoundError:
+                pass
+
+        total_size = sum([size for mtime, size, cache_file in files])
+        removed = 0
+        for mtime, size, cache_file in sorted(files):
+            if total_size <= self.max_size:
+                break
+
+            cache_file.unlink(missing_ok=True)
+            total_size -= size
+            removed += 1
+
+        return removed
+
+
+def decode_audio(path, cache=None):
+    """
+    Decode an audio file to 16 kHz mono samples
+
+    With a cache, the samples are stored in the cache rather than returned,
+    so they do not need to be copied between processes, and files that are
+    already in the cache are not decoded at all.
+
+    :param Path path:  Audio (or video) file
+    :param AudioCache cache:  Cache to store decoded audio in, if any
+    :return tuple:  File hash (if there is a cache), samples (as a float32 array, if there is no cache), and error
+    message (if the file could not be decoded)
+    """
+    try:
+        if cache:
+            digest = file_hash(path)
+            if not cache.contains(digest):
+                cache.put(digest, whisper.load_audio(str(path)))
+            return digest, None, None
+
+        return None, whisper.load_audio(str(path)), None
+    except Exception as e:
+        return None, None, str(e).strip().split("\n")[-1]
+
+
+def decode_files(paths, workers=1, prefetch=None, cache=None, evict_every=20):
+    """
+    Decode audio files in background processes, ahead of transcription
+
+    Decoding is done by ffmpeg, and takes long enough to keep the model idle
+    for a good part of the time if done in between files. At most `prefetch`
+    files are decoded ahead of the consumer, so memory use stays bounded for
+    large folders. The cache is kept within its maximum size while decoding,
+    except for the files that have been decoded but not yet transcribed.
+
+    :param paths:  Iterable of audio files
+    :param int workers:  Number of decoding processes
+    :param int prefetch:  Number of files to decode ahead; twice the number of workers by default
+    :param AudioCache cache:  Cache to read decoded audio from and store it in, if any
+    :param int evict_every:  Remove least recently used files from the cache after this many files
+    :return:  Generator of (path, samples, error) tuples, in the order of `paths`
+    """
+    paths = iter(paths)
+    decoded = 0
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = collections.deque((path, pool.submit(decode_audio, path, cache)) for path in itertools.islice(paths, prefetch or max(1, workers) * 2))
+        while pending:
+            path, future = pending.popleft()
+            for next_path in itertools.islice(paths, 1):
+                pending.append((next_path, pool.submit(decode_audio, next_path, cache)))
+
+            digest, samples, error = future.result()
+            if digest:
+                samples = cache.get(digest)
+                if samples is None:
+                    # removed in the meantime, e.g. by another run using the same cache
+                    digest, samples, error = decode_audio(path)
+
+            decoded += 1
+            if cache and decoded % evict_every == 0:
+                # files still being decoded are the most recently used, so they go last anyway
+                keep = {digest} | {future.result()[0] for next_path, future in pending if future.done()}
+                removed = cache.evict(keep)
+                if removed:
+                    print(f"Removed {removed} least recently used files from the audio cache")
+
+            yield path, samples, error
+
+
+def main(argv=None, models=None):
+    """
+    Transcribe a folder of audio files with the given command line arguments
+
+    :param list argv:  Command line arguments; `sys.argv` if `None`
+    :param models:  `dmi_worker.ModelCache` to keep models loaded between runs, when running as a worker
+    """
+    args = parse_args(argv)
+    status = StatusReporter(args.dmi_sm_server, args.database_key)
+    load = models.get if models is not None else lambda key, loader: loader()
+
+    output_folder = Path(args.output_dir)
+    if not output_folder.exists():
+        status.log(f"Output folder {args.output_dir} not found.")
+        exit(1)
+
+    audio_folder = Path(args.audio_folder)
+    if not audio_folder.is_dir():
+        status.log(f"Audio folder {args.audio_folder} not found.")
+        exit(1)
+
+    status.log(f"Setting up model ({args.model} on {device})...")
+    model = load(("whisper", args.model, device), lambda: whisper.load_model(args.model, device=device))
+
+    files = sorted([path for path in audio_folder.glob("*") if path.is_file()])
+    output_path = output_folder.joinpath(args.dataset_name + ".ndjson")
+
+    cache = None if args.no_cache else AudioCache(args.cache_dir, int(args.cache_size * 1024 ** 3))
+
+    done = 0
+    failed = 0
+    start = time.time()
+    profiler = Profiler(args.profile)
+    status.log(f"Transcribing {len(files)} files...", num_records=0)
+    with output_path.open("w") as outfile:
+        for path, audio, error in timed("decode", decode_files(files, args.workers, cache=cache)):
+            if audio is None:
+                print(f"Could not decode {path.name}, skipping ({error})", file=sys.stderr)
+                failed += 1
+                continue
+
+            with stage("model", items=1, sync=True):
+                result = model.transcribe(audio, language=args.language, task=args.task, fp16=device == "cuda")
+
+            # same content as the JSON files written by the whisper command line tool
+            with stage("write", items=1):
+                outfile.write(json.dumps({path.name: result}) + "\n")
+                outfile.flush()
+
+            done += 1
+            with stage("status"):
+                status.log(annotate(f"Transcribed {done} of {len(files)} files"), num_records=done)
+
+    if cache:
+        removed = cache.evict()
+        if removed:
+            print(f"Removed {removed} least recently used files from the audio cache")
+
+    elapsed = time.time() - start
+    print(f"Transcribed {done} files in {elapsed:.1f} seconds ({done / elapsed if elapsed else 0:.2f} files/sec)" +
+          (f"; {failed} files could not be decoded" if failed else ""))
+    profiler.finish(output_folder.joinpath(f"{args.dataset_name}-profile.json"), status)
+
+
+if __name__ == "__main__":
+    main()
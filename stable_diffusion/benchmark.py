@@ -0,0 +1,63 @@
+"""
+Measure SDXL generation time per image for different presets
+
+Uses a fixed prompt, so no prompt file is needed. For example, to see which
+presets are usable on a CPU-only machine:
+
+    python3 benchmark.py --cpu --presets fast,draft --no-refiner --images 2
+"""
+import argparse
+import time
+
+import torch
+
+import interface
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--presets", help=f"Comma-separated presets (options: {', '.join(interface.presets)}; default all)",
+                     default=",".join(interface.presets))
+    cli.add_argument("--images", "-n", help="Number of images per preset (default 4)", type=int, default=4)
+    cli.add_argument("--batch-size", "-b", help="Number of images to generate at once (default 1)", type=int, default=1)
+    cli.add_argument("--prompt", "-p", help="Prompt to use", default="a lighthouse on a rocky coast at sunset")
+    cli.add_argument("--dtype", help=f"Model precision (options: {', '.join(interface.dtypes)}; default auto)", default="auto")
+    cli.add_argument("--threads", help="Number of threads to use on CPU (default: torch's default)", type=int, default=0)
+    cli.add_argument("--no-refiner", help="Only run the base model", action="store_true", default=False)
+    cli.add_argument("--cpu", help="Run on CPU even if a GPU is available", action="store_true", default=False)
+    args = cli.parse_args()
+
+    device = "cpu" if args.cpu or not interface.have_cuda else "cuda"
+    dtype = interface.resolve_dtype(args.dtype, device)
+    if device == "cpu" and args.threads:
+        torch.set_num_threads(args.threads)
+
+    start = time.time()
+    base, refiner = interface.load_sdxl1(device, dtype, not args.no_refiner)
+    load_time = time.time() - start
+    print(f"Loaded models on {device} ({dtype}) in {load_time:.1f}s")
+
+    encoder = interface.PromptEncoder(base, refiner)
+    prompts = [{"prompt": args.prompt, "negative": ""}] * args.images
+
+    results = []
+    for preset in args.presets.split(","):
+        interface.set_scheduler([pipeline for pipeline in (base, refiner) if pipeline], preset)
+        steps = interface.presets[preset]["steps"]
+
+        # warm up, so one-off initialisation is not measured
+        base_kwargs, refiner_kwargs = encoder.encode_batch(prompts[:1])
+        interface.generate_batch(base, refiner, base_kwargs, refiner_kwargs, steps)
+
+        start = time.time()
+        for batch in interface.batched(prompts, max(1, args.batch_size)):
+            base_kwargs, refiner_kwargs = encoder.encode_batch(batch)
+            interface.generate_batch(base, refiner, base_kwargs, refiner_kwargs, steps)
+        elapsed = time.time() - start
+
+        results.append((preset, steps, elapsed / len(prompts)))
+        print(f"{preset:>8s}, {steps:>3d} steps: {elapsed / len(prompts):.1f} seconds/image")
+
+    print(f"\n{'preset':>8s} {'steps':>6s} {'s/image':>8s}")
+    for preset, steps, seconds in results:
+        print(f"{preset:>8s} {steps:>6d} {seconds:>8.1f}")
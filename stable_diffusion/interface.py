@@ -1,27 +1,62 @@
 import argparse
-import requests
+import itertools
+import threading
+import signal
 import json
 import torch
 import sys
 import re
-from urllib.parse import quote_plus
-import requests
 
-from diffusers import DiffusionPipeline
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from diffusers import DiffusionPipeline, EulerDiscreteScheduler, DPMSolverMultistepScheduler
 from pathlib import Path
+from dmi_status import StatusReporter
+from dmi_profile import Profiler, annotate, stage
 
 have_cuda = torch.cuda.is_available()
+dtypes = ["auto", "float16", "bfloat16", "float32"]
 
+# schedulers and number of steps; SDXL comes with the Euler scheduler, while
+# DPM++ 2M Karras gives comparable images in far fewer steps
+schedulers = {
+    "euler": (EulerDiscreteScheduler, {"use_karras_sigmas": False}),
+    "dpm++": (DPMSolverMultistepScheduler, {"use_karras_sigmas": True, "algorithm_type": "dpmsolver++"}),
+}
+presets = {
+    "default": {"scheduler": "euler", "steps": 40},
+    "fast": {"scheduler": "dpm++", "steps": 20},
+    "draft": {"scheduler": "dpm++", "steps": 8},
+}
 
-def parse_args():
+
+def parse_args(argv=None):
     """
     Parse command line arguments
+
+    :param list argv:  Arguments to parse; `sys.argv` if `None`
     """
     cli = argparse.ArgumentParser()
     cli.add_argument("--prompts-file", "-f", help="Path to prompt file, one prompt per line")
     cli.add_argument("--prompt", "-p", help="Text prompt")
     cli.add_argument("--negative-prompt", "-n", help="Negative prompt", default="")
-    cli.add_argument("--steps", "-s", help="Number of steps (default 40)", default=40, type=int)
+    cli.add_argument("--preset", help="Scheduler and number of steps (options: " + ", ".join([f"{name} ({preset['scheduler']}, {preset['steps']} steps)" for name, preset in presets.items()]) + ")",
+                     choices=presets.keys(), default="default")
+    cli.add_argument("--steps", "-s", help="Number of steps (default: as per the preset)", default=None, type=int)
+    cli.add_argument("--no-refiner", help="Only run the base model, for all steps; faster, particularly on CPU, but less detailed",
+                     action="store_true")
+    cli.add_argument("--cpu", help="Run on CPU even if a GPU is available", action="store_true")
+    cli.add_argument("--dtype", help=f"Model precision (options: {', '.join(dtypes)}); 'auto' uses float16 on GPU and float32 on CPU",
+                     choices=dtypes, default="auto")
+    cli.add_argument("--threads", help="Number of threads to use on CPU (default: torch's default)", default=0, type=int)
+    cli.add_argument("--batch-size", "-b", help="Number of prompts to generate images for at once (default 1); larger batches are faster but need more GPU memory",
+                     default=1, type=int)
+    cli.add_argument("--lossless", help="Also save a lossless PNG version of each image", action="store_true")
+    cli.add_argument("--preview-size", help="Also save a JPEG preview of each image, scaled down to at most this many pixels wide and high (default 0: no previews)",
+                     default=0, type=int)
+    cli.add_argument("--preview-quality", help="JPEG quality of previews, 1-95 (default 60)", default=60, type=int)
+    cli.add_argument("--profile", help="Time each processing stage and write a summary to profile.json in the output directory (or set DMI_PROFILE=1)",
+                     action="store_true")
     cli.add_argument("--output-dir", "-o", help="Output directory where image will be saved", default="data", required=True)
     # These arguments are added by the DMI Service Manager in order for the service to, if desired, provide status updates which will be logged in the DMI Service Manager database.
     cli.add_argument("--database_key", "-k", default="",
@@ -29,15 +64,8 @@ def parse_args():
     cli.add_argument("--dmi_sm_server", "-m", default="",
                      help="DMI Service Manager server address to provide status updates.")
 
-    return cli.parse_args()
+    return cli.parse_args(argv)
 
-def log(message, server=None, db_key=None, num_records=None):
-    print(message)
-    if server and db_key:
-        try:
-            requests.post(f"{server}/status_update/?key={db_key}&status=running&message={quote_plus(message)}{'&num_records=' + str(num_records) if num_records else ''}")
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to log status update: {e}")
 
 def make_filename(prompt_id, prompt):
     """
@@ -53,36 +81,307 @@ def make_filename(prompt_id, prompt):
     return f"{prompt_id}-{safe_prompt}.jpeg"
 
 
-def use_sdxl1(args, prompts):
+def resolve_dtype(dtype, device):
+    """
+    Pick the model precision for a device
+
+    float16 is fast on GPUs, but very slow (or unsupported) for matrix
+    multiplications on most CPUs, so use float32 there unless told otherwise.
+
+    :param str dtype:  One of `dtypes`
+    :param str device:  `cuda` or `cpu`
+    :return str:  Resolved dtype
+    """
+    if dtype == "auto":
+        return "float16" if device == "cuda" else "float32"
+
+    return dtype
+
+
+def load_sdxl1(device="cuda" if have_cuda else "cpu", dtype="float16", with_refiner=True):
+    """
+    Load the SDXL 1.0 base and refiner pipelines
+
+    On CPU, attention is computed in slices and the VAE decodes in tiles, to
+    keep memory use in check; model CPU offloading only makes sense with a
+    GPU to offload from.
+
+    :param str device:  `cuda` or `cpu`
+    :param str dtype:  Resolved dtype, see `resolve_dtype`
+    :param bool with_refiner:  Whether to load the refiner; if not, `None` is returned instead of the refiner pipeline
+    :return tuple:  Base and refiner pipelines
+    """
+    torch_dtype = getattr(torch, dtype)
+
     # load both base & refiner
     base = DiffusionPipeline.from_pretrained(
         "stable-diffusion-xl-base-1.0",
-        torch_dtype=torch.float16,
+        torch_dtype=torch_dtype,
         variant="fp16",
         use_safetensors=True
     )
 
-    if have_cuda:
-        base.to("cuda")
+    pipelines = [base]
+    if with_refiner:
+        refiner = DiffusionPipeline.from_pretrained(
+            "stable-diffusion-xl-refiner-1.0",
+            text_encoder_2=base.text_encoder_2,
+            vae=base.vae,
+            torch_dtype=torch_dtype,
+            use_safetensors=True,
+            variant="fp16",
+        )
+        pipelines.append(refiner)
     else:
-        base.enable_model_cpu_offload()
-
-    refiner = DiffusionPipeline.from_pretrained(
-        "stable-diffusion-xl-refiner-1.0",
-        text_encoder_2=base.text_encoder_2,
-        vae=base.vae,
-        torch_dtype=torch.float16,
-        use_safetensors=True,
-        variant="fp16",
-    )
+        refiner = None
 
-    if have_cuda:
-        refiner.to("cuda")
-    else:
-        refiner.enable_model_cpu_offload()
+    for pipeline in pipelines:
+        pipeline.to(device)
+        if device == "cpu":
+            pipeline.enable_attention_slicing()
+            pipeline.enable_vae_tiling()
+
+    return base, refiner
+
+
+def set_scheduler(pipelines, preset):
+    """
+    Use the scheduler of a preset for the given pipelines
+
+    :param list pipelines:  Pipelines
+    :param str preset:  Preset name, see `presets`
+    """
+    scheduler, options = schedulers[presets[preset]["scheduler"]]
+    for pipeline in pipelines:
+        pipeline.scheduler = scheduler.from_config(pipeline.scheduler.config, **options)
+
+
+def generate_batch(base, refiner, base_kwargs, refiner_kwargs, n_steps, high_noise_frac=0.8):
+    """
+    Generate images for a batch of encoded prompts
+
+    :param base:  Base pipeline
+    :param refiner:  Refiner pipeline; if `None`, the base model runs all steps
+    :param dict base_kwargs:  Encoded prompts for the base pipeline, see `PromptEncoder.encode_batch`
+    :param dict refiner_kwargs:  Encoded prompts for the refiner pipeline, see `PromptEncoder.encode_batch`
+    :param int n_steps:  Number of steps
+    :param float high_noise_frac:  Fraction of steps to run with the base model, if there is a refiner
+    :return list:  Images
+    """
+    if not refiner:
+        return base(**base_kwargs, num_inference_steps=n_steps).images
+
+    # run both experts
+    images = base(
+        **base_kwargs,
+        num_inference_steps=n_steps,
+        denoising_end=high_noise_frac,
+        output_type="latent",
+    ).images
+
+    return refiner(
+        **refiner_kwargs,
+        num_inference_steps=n_steps,
+        denoising_start=high_noise_frac,
+        image=images,
+    ).images
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+class ImageWriter:
+    """
+    Encode and save images in background threads
+
+    Encoding a JPEG and writing it to disk takes long enough to leave the GPU
+    idle for a noticeable time after every batch. Images are instead saved by
+    a small thread pool while the next batch is generated. At most
+    `max_pending` images are waiting to be saved at any time, so images do
+    not pile up in memory if saving is slower than generating them.
+    """
+    def __init__(self, output_dir, status, workers=2, max_pending=8, lossless=False, preview_size=0, preview_quality=60):
+        """
+        :param Path output_dir:  Folder to save images in
+        :param StatusReporter status:  Reporter to log progress with, once an image has been saved
+        :param int workers:  Number of threads to save images with
+        :param int max_pending:  Maximum number of images waiting to be saved
+        :param bool lossless:  Also save a PNG version of each image
+        :param int preview_size:  Also save a scaled down JPEG preview of each image, at most this many pixels wide and
+        high; 0 to save no previews
+        :param int preview_quality:  JPEG quality of previews
+        """
+        self.output_dir = Path(output_dir)
+        self.status = status
+        self.lossless = lossless
+        self.preview_size = preview_size
+        self.preview_quality = preview_quality
+
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="image-writer")
+        self.pending = threading.BoundedSemaphore(max(1, max_pending))
+        self.futures = []
+        self.lock = threading.Lock()
+        self.done = 0
+
+    def submit(self, image, filename):
+        """
+        Queue an image to be saved
+
+        Blocks while the maximum number of images is already waiting.
+
+        :param Image image:  Image to save
+        :param str filename:  File name, as generated by `make_filename`
+        """
+        self.pending.acquire()
+
+        # raise errors from earlier images now, rather than after generating all others
+        for future in [future for future in self.futures if future.done()]:
+            future.result()
+            self.futures.remove(future)
+
+        self.futures.append(self.pool.submit(self.write, image, filename))
+
+    def write(self, image, filename):
+        try:
+            with stage("save", items=1):
+                path = self.output_dir.joinpath(filename)
+                image.save(path)
+
+                if self.lossless:
+                    image.save(path.with_suffix(".png"))
+
+                if self.preview_size:
+                    preview = image.copy()
+                    preview.thumbnail((self.preview_size, self.preview_size))
+                    preview.save(path.with_name(f"{path.stem}-preview{path.suffix}"), quality=self.preview_quality)
+
+            with self.lock, stage("status"):
+                self.done += 1
+                self.status.log(annotate(f"Generated {self.done} image(s)"), num_records=self.done)
+        finally:
+            self.pending.release()
+
+    def close(self):
+        """
+        Wait for all queued images to be saved
+
+        Raises the first error that occurred while saving, if any.
+        """
+        self.pool.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+
+class PromptEncoder:
+    """
+    Encode prompts for the base and refiner pipelines, once per unique text
+
+    The pipelines would otherwise run their text encoders for every image,
+    even though 4CAT prompt files often repeat prompts, and the negative
+    prompt is usually the same for all of them. Prompts and negative prompts
+    are encoded the same way, so both share one cache. The embeddings stay on
+    the GPU, so only the most recently used ones are kept; a prompt used for
+    every batch, like the negative prompt, stays cached.
+
+    The refiner only uses the second text encoder, which it shares with the
+    base pipeline; the base pipeline's embeddings are those of both encoders
+    concatenated, so the refiner's embeddings are a slice of them, and its
+    pooled embeddings are the same.
+    """
+    def __init__(self, base, refiner, max_size=32):
+        """
+        :param base:  SDXL base pipeline
+        :param refiner:  SDXL refiner pipeline, or `None` if not used
+        :param int max_size:  Number of encoded prompts to keep
+        """
+        self.base = base
+        self.refiner = refiner
+        self.shared = refiner is None or (refiner.text_encoder is None and refiner.text_encoder_2 is base.text_encoder_2)
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+    def encode(self, text):
+        """
+        Encode a prompt
+
+        :param str text:  Prompt; if `None`, the negative prompt is left empty, as the pipelines would
+        :return tuple:  Base embeddings, base pooled embeddings, refiner embeddings and refiner pooled embeddings, each
+        for a batch of one; the refiner embeddings are the base ones if there is no refiner
+        """
+        if text in self.cache:
+            self.cache.move_to_end(text)
+        else:
+            if text is None:
+                # without a negative prompt, the pipelines either encode an empty prompt, or use zeros
+                embeddings = self.encode("")
+                base_zeros = self.base.config.force_zeros_for_empty_prompt
+                refiner_zeros = self.refiner.config.force_zeros_for_empty_prompt if self.refiner else base_zeros
+                self.cache[text] = tuple([torch.zeros_like(embedding) if zeros else embedding for embedding, zeros in
+                                          zip(embeddings, (base_zeros, base_zeros, refiner_zeros, refiner_zeros))])
+            else:
+                with torch.no_grad():
+                    base_embeds, _, base_pooled, _ = self.base.encode_prompt(prompt=text, do_classifier_free_guidance=False)
+                    if not self.refiner:
+                        refiner_embeds = base_embeds
+                        refiner_pooled = base_pooled
+                    elif self.shared:
+                        refiner_embeds = base_embeds[..., -self.refiner.text_encoder_2.config.hidden_size:]
+                        refiner_pooled = base_pooled
+                    else:
+                        refiner_embeds, _, refiner_pooled, _ = self.refiner.encode_prompt(prompt=text, do_classifier_free_guidance=False)
+
+                self.cache[text] = (base_embeds, base_pooled, refiner_embeds, refiner_pooled)
+
+            # a batch holds on to the embeddings it uses, so those can be evicted while it is being encoded
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+        return self.cache[text]
+
+    def encode_batch(self, prompts):
+        """
+        Encode a batch of prompts and negative prompts
+
+        :param list prompts:  Prompts, as dictionaries with `prompt` and `negative` keys
+        :return tuple:  Keyword arguments for the base and refiner pipelines
+        """
+        positive = [self.encode(prompt["prompt"]) for prompt in prompts]
+        negative = [self.encode(prompt.get("negative")) for prompt in prompts]
+
+        def stack(embeddings, index):
+            return torch.cat([embedding[index] for embedding in embeddings])
+
+        base_kwargs = {"prompt_embeds": stack(positive, 0), "pooled_prompt_embeds": stack(positive, 1),
+                       "negative_prompt_embeds": stack(negative, 0), "negative_pooled_prompt_embeds": stack(negative, 1)}
+        refiner_kwargs = {"prompt_embeds": stack(positive, 2), "pooled_prompt_embeds": stack(positive, 3),
+                          "negative_prompt_embeds": stack(negative, 2), "negative_pooled_prompt_embeds": stack(negative, 3)}
+
+        return base_kwargs, refiner_kwargs
+
+
+def use_sdxl1(args, pipelines=None):
+    """
+    Generate images with SDXL 1.0
+
+    :param args:  Parsed command line arguments
+    :param tuple pipelines:  Base and refiner pipelines from `load_sdxl1`; loaded if not given
+    """
+    status = StatusReporter(args.dmi_sm_server, args.database_key)
+    device = "cpu" if args.cpu or not have_cuda else "cuda"
+    if device == "cpu" and args.threads:
+        torch.set_num_threads(args.threads)
+
+    base, refiner = pipelines if pipelines else load_sdxl1(device, resolve_dtype(args.dtype, device), not args.no_refiner)
+    if args.no_refiner:
+        refiner = None
+
+    set_scheduler([pipeline for pipeline in (base, refiner) if pipeline], args.preset)
 
     # Define how many steps and what % of steps to be run on each experts (80/20) here
-    n_steps = args.steps
+    n_steps = args.steps or presets[args.preset]["steps"]
     high_noise_frac = 0.8
 
     if args.prompts_file:
@@ -91,33 +390,59 @@ def use_sdxl1(args, prompts):
     else:
         prompts = {1: {"prompt": args.prompt, "negative": args.negative_prompt}}
 
-    done = 0
-    for prompt_id, prompt in prompts.items():
-        if not prompt["prompt"]:
-            continue
-
-        print(repr(prompt), file=sys.stderr)
-
-        # run both experts
-        image = base(
-            prompt=prompt["prompt"],
-            negative_prompt=prompt["negative"],
-            num_inference_steps=n_steps,
-            denoising_end=high_noise_frac,
-            output_type="latent",
-        ).images
-
-        image = refiner(
-            prompt=prompt["prompt"],
-            negative_prompt=prompt["negative"],
-            num_inference_steps=n_steps,
-            denoising_start=high_noise_frac,
-            image=image,
-        ).images[0]
-
-        filename = make_filename(prompt_id, prompt["prompt"])
-        image.save(Path(args.output_dir).joinpath(filename))
-        done += 1
-
-        log(f"Generated {done} image(s)", args.dmi_sm_server, args.database_key, num_records=done)
-        
+    # save all images that have been generated so far when stopped
+    def exit_on_signal(signum, frame):
+        raise SystemExit(128 + signum)
+
+    in_main_thread = threading.current_thread() is threading.main_thread()
+    previous_handler = signal.signal(signal.SIGTERM, exit_on_signal) if in_main_thread else None
+
+    encoder = PromptEncoder(base, refiner, max_size=max(32, 2 * args.batch_size))
+    profiler = Profiler(args.profile)
+    writer = ImageWriter(args.output_dir, status, lossless=args.lossless, preview_size=args.preview_size,
+                         preview_quality=args.preview_quality)
+    try:
+        for batch in batched([(prompt_id, prompt) for prompt_id, prompt in prompts.items() if prompt["prompt"]],
+                             max(1, args.batch_size)):
+            for prompt_id, prompt in batch:
+                print(repr(prompt), file=sys.stderr)
+
+            with stage("encode prompts", items=len(batch), sync=True):
+                base_kwargs, refiner_kwargs = encoder.encode_batch([prompt for prompt_id, prompt in batch])
+
+            with stage("model", items=len(batch), sync=True):
+                images = generate_batch(base, refiner, base_kwargs, refiner_kwargs, n_steps, high_noise_frac)
+
+            # time spent waiting for the image writer, when it cannot keep up
+            with stage("save queue", items=len(batch)):
+                for (prompt_id, prompt), image in zip(batch, images):
+                    writer.submit(image, make_filename(prompt_id, prompt["prompt"]))
+    finally:
+        writer.close()
+        if in_main_thread:
+            signal.signal(signal.SIGTERM, previous_handler if previous_handler is not None else signal.SIG_DFL)
+
+    profiler.finish(Path(args.output_dir).joinpath("profile.json"), status)
+
+
+def main(argv=None, models=None):
+    """
+    Generate images with the given command line arguments
+
+    :param list argv:  Command line arguments; `sys.argv` if `None`
+    :param models:  `dmi_worker.ModelCache` to keep models loaded between runs, when running as a worker
+    """
+    args = parse_args(argv)
+    if not args.prompt and not args.prompts_file:
+        print("Must specify either --prompt or --prompts-file.", file=sys.stderr)
+        exit(1)
+
+    device = "cpu" if args.cpu or not have_cuda else "cuda"
+    dtype = resolve_dtype(args.dtype, device)
+    load = models.get if models is not None else lambda key, loader: loader()
+    use_sdxl1(args, load(("sdxl1", device, dtype, not args.no_refiner),
+                         lambda: load_sdxl1(device, dtype, not args.no_refiner)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,687 @@
 import itertools
 import argparse
+import collections
+import copy
+import hashlib
+import multiprocessing
+import os
+import queue
+import re
+import sqlite3
+import threading
 import torch
 import yaml
 import json
 import sys
-from urllib.parse import quote_plus
-import requests
 
 from pathlib import Path
+from dmi_status import StatusReporter
+from dmi_profile import Profiler, annotate, stage, timed
+from thefuzz import process
 from stormtrooper import Text2TextZeroShotClassifier, Text2TextFewShotClassifier, GenerativeZeroShotClassifier, \
     GenerativeFewShotClassifier
 
+try:
+    # considerably faster than the standard library for large inputs
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 have_cuda = torch.cuda.is_available()
 gpu_or_cpu = "cuda:0" if have_cuda else "cpu"
 
-def count_lines(path):
+def decode_lines(lines):
     """
-    Get the amount of (new)lines in a file.
+    Decode a number of NDJSON lines at once
 
-    Thanks to https://stackoverflow.com/a/27517681!
+    One parser call for the whole batch is faster than one per line.
 
-    :param path:  File to read
-    :return int:  Amount of lines
+    :param list lines:  Lines, as bytes
+    :return list:  Decoded objects
     """
-    def _make_gen(reader):
-        b = reader(1024 * 1024)
-        while b:
-            yield b
-            b = reader(1024 * 1024)
+    return json_loads(b"[" + b",".join(lines) + b"]")
+
+
+def read_batches(path, batch_size, prefetch=4):
+    """
+    Read and decode an NDJSON file in batches, in a background thread
+
+    The file is read only once, while the consumer works on earlier batches.
+    At most `prefetch` batches are read ahead.
 
-    with open(path, "rb") as f:
-        f_gen = _make_gen(f.raw.read)
+    :param Path path:  NDJSON file, one or more `{item_id: text}` objects per line
+    :param int batch_size:  Number of lines per batch
+    :param int prefetch:  Number of batches to read ahead
+    :return:  Generator of (items, lines read, bytes read, error) tuples; `error` is set, and is the last tuple, if a
+    line could not be parsed
+    """
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
 
-        return sum(buf.count(b"\n") for buf in f_gen)
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-def log(message, server=None, db_key=None, num_records=None):
-    print(message)
-    if server and db_key:
+    def reader():
+        line_number = 0
+        bytes_read = 0
         try:
-            requests.post(f"{server}/status_update/?key={db_key}&status=running&message={quote_plus(message)}{'&num_records=' + str(num_records) if num_records else ''}")
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to log status update: {e}")
+            with path.open("rb") as infile:
+                while True:
+                    lines = []
+                    for line in itertools.islice(infile, batch_size):
+                        bytes_read += len(line)
+                        lines.append(line)
 
-if __name__ == "__main__":
+                    if not lines:
+                        break
+
+                    items = {}
+                    error = None
+                    try:
+                        for item in decode_lines([line for line in lines if line.strip()]):
+                            items.update(item)  # theoretically, could be any number of items per line (but one is recommended)
+                        line_number += len(lines)
+                    except Exception:
+                        # decode line by line to keep the items before the broken line; besides invalid JSON, this
+                        # catches lines that are valid JSON but not an object (e.g. a number or a list)
+                        items = {}
+                        for line in lines:
+                            line_number += 1
+                            try:
+                                if line.strip():
+                                    items.update(json_loads(line))
+                            except Exception:
+                                error = f"Error parsing line {line_number:,} from {path} as a JSON object. Saving results so far and halting."
+                                break
+
+                    if not put((items, line_number, bytes_read, error)) or error:
+                        break
+        except Exception as e:
+            put(({}, line_number, bytes_read, f"Error reading {path}: {e}. Saving results so far and halting."))
+        finally:
+            # the consumer waits for this, so it must always be sent
+            put(None)
+
+    threading.Thread(target=reader, daemon=True).start()
+    try:
+        while (batch := batches.get()) is not None:
+            yield batch
+            if batch[3]:
+                break
+    finally:
+        stop.set()
+
+
+class ResultWriter:
+    """
+    Write classification results to a single output file
+
+    Keeps one file handle open and buffers output. Results are written as
+    NDJSON (one `{item_id: labels}` object per line), or as a single JSON
+    object mapping item IDs to labels, which is completed when the writer is
+    closed. The file is synced to disk at the end of every batch.
+    """
+    def __init__(self, path, output_format="json"):
+        """
+        :param Path path:  File to write to; will be overwritten
+        :param str output_format:  `json` or `ndjson`
+        """
+        self.output_format = output_format
+        self.count = 0
+        self.outfile = path.open("w", buffering=1024 * 1024)
+        if output_format == "json":
+            self.outfile.write("{\n")
+
+    def write_batch(self, items):
+        """
+        Write results for a batch of items
+
+        :param items:  Iterable of (item ID, labels) tuples
+        """
+        for item_id, labels in items:
+            if self.output_format == "ndjson":
+                self.outfile.write(json.dumps({item_id: labels}) + "\n")
+            else:
+                if self.count:
+                    self.outfile.write(",\n")
+                self.outfile.write(f"  {json.dumps(item_id)}: {json.dumps(labels)}")
+            self.count += 1
+
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+
+    def close(self):
+        if self.output_format == "json":
+            self.outfile.write("\n}")
+        self.outfile.close()
+
+
+def is_out_of_memory(e):
+    # torch.cuda.OutOfMemoryError is a RuntimeError, but older versions of torch raise a plain RuntimeError
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+class LengthBucketedBatcher:
+    """
+    Classify items in batches of texts with similar lengths
+
+    Items in a batch are padded to the longest item, so mixing short and long
+    texts wastes most of the computation. Items are instead sorted by the
+    length of their prompt in tokens and grouped into batches that fit a token
+    budget (number of items times the longest prompt). When a batch runs out
+    of memory, it is split in half and retried, and the budget is lowered for
+    later batches.
+    """
+    def __init__(self, predictor, token_budget=8192, max_batch_size=100):
+        """
+        :param BatchedGenerator predictor:  Generator to classify each batch with
+        :param int token_budget:  Maximum padded tokens per batch, including the prompt template
+        :param int max_batch_size:  Maximum number of items per batch
+        """
+        self.predictor = predictor
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+
+    def make_batches(self, lengths):
+        """
+        Group items into batches that fit the token budget
+
+        :param list lengths:  Prompt length in tokens per item
+        :return list:  Batches, as lists of item indexes
+        """
+        batches = []
+        batch = []
+        for index in sorted(range(len(lengths)), key=lambda index: lengths[index]):
+            # items are sorted by length, so this item is the longest in the batch
+            if batch and ((len(batch) + 1) * lengths[index] > self.token_budget or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def predict(self, texts):
+        """
+        Classify texts
+
+        :param list texts:  Texts to classify
+        :return list:  Predicted labels, in the same order as `texts`, or `None` if the predictor returned nothing
+        """
+        predictions = [None] * len(texts)
+        pending = self.make_batches(self.predictor.prompt_lengths(texts))
+        while pending:
+            batch = pending.pop(0)
+            try:
+                predicted_labels = self.predictor.predict([texts[index] for index in batch])
+            except RuntimeError as e:
+                if not is_out_of_memory(e) or len(batch) == 1:
+                    raise
+
+                torch.cuda.empty_cache()
+                self.token_budget = max(1, self.token_budget // 2)
+                print(f"Out of memory for a batch of {len(batch):,} items; retrying in smaller batches (token budget now {self.token_budget:,})",
+                      file=sys.stderr)
+                pending[0:0] = [batch[:len(batch) // 2], batch[len(batch) // 2:]]
+                continue
+
+            if predicted_labels is None:
+                return None
+
+            for index, label in zip(batch, list(predicted_labels)):
+                predictions[index] = label
+
+        return predictions
+
+
+def text_hash(text):
+    """
+    Hash a text for deduplication
+
+    Texts are normalised first, so texts that differ only in whitespace are
+    considered identical.
+
+    :param str text:  Text
+    :return str:  Hash
+    """
+    return hashlib.sha256(re.sub(r"\s+", " ", str(text)).strip().encode("utf-8")).hexdigest()
+
+
+class PredictionCache:
+    """
+    Cache of predicted labels per text
+
+    Predictions are only valid for a given model, prompt, and set of labels and
+    examples, so these are hashed into a configuration key that is stored with
+    every prediction. Without a file, predictions are only kept in memory for
+    the current run.
+    """
+    def __init__(self, config, path=None):
+        """
+        :param config:  JSON-serialisable description of model, prompt, labels and examples
+        :param path:  SQLite file to store predictions in, or `None`
+        """
+        self.config = hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+        self.memory = {}
+        self.db = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS predictions (config TEXT, text_hash TEXT, label TEXT, PRIMARY KEY (config, text_hash))")
+
+    def get_many(self, hashes):
+        """
+        :param hashes:  Text hashes
+        :return dict:  Hash -> label, for hashes that are in the cache
+        """
+        if not self.db:
+            return {digest: self.memory[digest] for digest in hashes if digest in self.memory}
+
+        cached = {}
+        hashes = list(hashes)
+        # stay well below SQLite's limit for the number of query parameters
+        for offset in range(0, len(hashes), 500):
+            chunk = hashes[offset:offset + 500]
+            rows = self.db.execute(f"SELECT text_hash, label FROM predictions WHERE config = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                                   (self.config, *chunk))
+            cached.update({digest: json.loads(label) for digest, label in rows})
+
+        return cached
+
+    def put_many(self, predictions):
+        """
+        :param dict predictions:  Hash -> label
+        """
+        if not self.db:
+            self.memory.update(predictions)
+            return
+
+        self.db.executemany("INSERT OR REPLACE INTO predictions (config, text_hash, label) VALUES (?, ?, ?)",
+                            [(self.config, digest, json.dumps(label)) for digest, label in predictions.items()])
+        self.db.commit()
+
+    def close(self):
+        if self.db:
+            self.db.close()
+
+
+class BatchedGenerator:
+    """
+    Classify texts with a stormtrooper classifier, one `generate()` call per batch
+
+    Stormtrooper's own `predict()` runs the model once per text, so batching
+    would make no difference. Instead, the prompts for a batch of texts are
+    padded to the same length and generated together, which is what makes
+    grouping texts of similar length (see `LengthBucketedBatcher`) worthwhile.
+    Prompts are built, and the output is turned into a label, the same way as
+    by the wrapped classifier.
+    """
+    def __init__(self, predictor):
+        """
+        :param predictor:  Fitted stormtrooper text2text or textgen classifier
+        """
+        self.predictor = predictor
+        self.model = predictor.model
+        self.tokenizer = predictor.tokenizer
+        self.encoder_decoder = self.model.config.is_encoder_decoder
+
+        # decoder-only models continue from the end of the input, so pad prompts on the left
+        if not self.encoder_decoder:
+            self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # the instructions, labels and examples are usually most of the prompt, particularly for short texts
+        self.template_length = len(self.tokenizer(self.build_prompt("")).input_ids)
+
+    def build_prompt(self, text):
+        """
+        Build the prompt for a text the way the wrapped classifier does
+
+        :param str text:  Text to classify
+        :return str:  Prompt
+        """
+        if hasattr(self.predictor, "generate_prompt"):
+            return self.predictor.generate_prompt(text)
+
+        return self.predictor.prompt.format(X=text, classes=", ".join([f"'{label}'" for label in self.predictor.classes_]))
+
+    def prompt_lengths(self, texts):
+        """
+        Get the length in tokens of the prompt for each text
+
+        Only the texts are tokenised; the length of the rest of the prompt is
+        determined once. This is exact unless the tokenizer merges tokens where
+        the text meets the rest of the prompt.
+
+        :param list texts:  Texts to classify
+        :return list:  Number of tokens per prompt
+        """
+        text_ids = self.tokenizer([str(text) for text in texts], add_special_tokens=False).input_ids
+        return [self.template_length + len(ids) for ids in text_ids]
+
+    def generate(self, prompts):
+        """
+        Generate responses to a batch of prompts
+
+        :param list prompts:  Prompts
+        :return list:  Generated text per prompt, without the prompt
+        """
+        inputs = self.tokenizer(prompts, padding=True, return_tensors="pt").to(self.predictor.device)
+        with torch.no_grad():
+            output = self.model.generate(**inputs, max_new_tokens=self.predictor.max_new_tokens,
+                                         pad_token_id=self.tokenizer.pad_token_id)
+
+        if not self.encoder_decoder:
+            # the output of decoder-only models starts with the (padded) prompt
+            output = output[:, inputs.input_ids.shape[1]:]
+
+        return self.tokenizer.batch_decode(output, skip_special_tokens=True)
+
+    def predict(self, texts):
+        """
+        Classify texts
+
+        :param list texts:  Texts to classify
+        :return list:  Predicted labels
+        """
+        predictions = []
+        for label in self.generate([self.build_prompt(text) for text in texts]):
+            if self.predictor.fuzzy_match and label not in self.predictor.classes_:
+                label, _ = process.extractOne(label, self.predictor.classes_)
+            predictions.append(label)
+
+        return predictions
+
+
+class PrefixCachedGenerator(BatchedGenerator):
+    """
+    Classify texts with a generative model, encoding the shared prompt prefix once
+
+    Every prompt starts with the same block of instructions, labels and (for
+    few-shot classification) examples, and only the text to classify differs.
+    Rather than encoding that block again for every batch, its attention
+    key/value cache is computed once, and generation for each batch continues
+    from there. Decoding is greedy, as with stormtrooper's own `generate()`
+    call, so labels are the same as without the prefix cache.
+
+    Prompts that do not start with the cached prefix tokens (e.g. because the
+    tokenizer merges the start of the text with the end of the prefix) are
+    generated in full.
+    """
+    # stands in for the text when determining the prompt prefix
+    placeholder = "\uffff"
+
+    def __init__(self, predictor):
+        """
+        :param predictor:  Fitted stormtrooper `GenerativeZeroShotClassifier` or `GenerativeFewShotClassifier`
+        """
+        super().__init__(predictor)
+
+        generation_config = self.model.generation_config
+        eos_token_id = generation_config.eos_token_id
+        self.eos_token_ids = torch.tensor(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id],
+                                          device=predictor.device)
+
+        # anything other than plain greedy decoding is left to generate()
+        enabled = not generation_config.do_sample and generation_config.num_beams == 1 \
+            and generation_config.repetition_penalty in (None, 1.0) and not generation_config.no_repeat_ngram_size \
+            and not generation_config.bad_words_ids and not generation_config.min_new_tokens \
+            and not generation_config.min_length
+
+        # the last prefix token is left out, since it is the one most likely to be
+        # merged with the start of the text by the tokenizer
+        prefix = self.build_prompt(self.placeholder).split(self.placeholder)[0]
+        self.prefix_ids = self.tokenizer(prefix).input_ids[:-1]
+        self.prefix_cache = None
+        if enabled and self.prefix_ids:
+            with torch.no_grad():
+                self.prefix_cache = self.model(input_ids=torch.tensor([self.prefix_ids], device=predictor.device),
+                                               use_cache=True).past_key_values
+
+    def expand_cache(self, batch_size):
+        """
+        Get a copy of the prefix cache for a batch of prompts
+
+        :param int batch_size:  Number of prompts
+        :return:  Key/value cache
+        """
+        if isinstance(self.prefix_cache, tuple):
+            # legacy caches (tuples of tensors) are not modified by the model
+            return tuple(tuple(tensor.repeat_interleave(batch_size, dim=0) for tensor in layer) for layer in self.prefix_cache)
+
+        # Cache objects are updated in place, so they need to be copied
+        past_key_values = copy.deepcopy(self.prefix_cache)
+        past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+
+    def generate_from_prefix(self, suffixes):
+        """
+        Greedily generate responses to prompts that start with the cached prefix
+
+        The rest of each prompt is padded on the left, i.e. between the prefix
+        and the text. The padding is masked out and not counted in the
+        position IDs, so the result is the same as for each prompt on its own.
+
+        :param list suffixes:  Token IDs of each prompt after the prefix
+        :return list:  Generated text per prompt
+        """
+        device = self.predictor.device
+        batch_size = len(suffixes)
+        length = max(len(suffix) for suffix in suffixes)
+        pad_token_id = self.tokenizer.pad_token_id
+
+        input_ids = torch.tensor([[pad_token_id] * (length - len(suffix)) + suffix for suffix in suffixes], device=device)
+        suffix_mask = torch.tensor([[0] * (length - len(suffix)) + [1] * len(suffix) for suffix in suffixes], device=device)
+        attention_mask = torch.cat([torch.ones(batch_size, len(self.prefix_ids), dtype=torch.long, device=device),
+                                    suffix_mask], dim=1)
+        position_ids = (len(self.prefix_ids) + suffix_mask.cumsum(dim=1) - 1).clamp(min=len(self.prefix_ids))
+        past_key_values = self.expand_cache(batch_size)
+
+        generated = []
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        with torch.no_grad():
+            for _ in range(self.predictor.max_new_tokens):
+                output = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                                    past_key_values=past_key_values, use_cache=True)
+                past_key_values = output.past_key_values
+                # as with generate(), sequences that have finished are continued with padding
+                next_ids = torch.where(finished, pad_token_id, output.logits[:, -1].argmax(dim=-1))
+                generated.append(next_ids)
+                finished |= torch.isin(next_ids, self.eos_token_ids)
+                if finished.all():
+                    break
+
+                input_ids = next_ids[:, None]
+                attention_mask = torch.cat([attention_mask, torch.ones(batch_size, 1, dtype=torch.long, device=device)], dim=1)
+                position_ids = position_ids[:, -1:] + 1
+
+        return self.tokenizer.batch_decode(torch.stack(generated, dim=1), skip_special_tokens=True)
+
+    def generate(self, prompts):
+        """
+        Generate responses to a batch of prompts, continuing from the prefix cache where possible
+
+        :param list prompts:  Prompts
+        :return list:  Generated text per prompt, without the prompt
+        """
+        if self.prefix_cache is None:
+            return super().generate(prompts)
+
+        prefix_length = len(self.prefix_ids)
+        input_ids = self.tokenizer(prompts).input_ids
+        cached = [index for index, ids in enumerate(input_ids)
+                  if len(ids) > prefix_length and ids[:prefix_length] == self.prefix_ids]
+        uncached = sorted(set(range(len(prompts))) - set(cached))
+
+        generated = [None] * len(prompts)
+        if cached:
+            responses = self.generate_from_prefix([input_ids[index][prefix_length:] for index in cached])
+            for index, response in zip(cached, responses):
+                generated[index] = response
+        if uncached:
+            for index, response in zip(uncached, super().generate([prompts[index] for index in uncached])):
+                generated[index] = response
+
+        return generated
+
+
+def load_predictor(model_type, model_name, labels, main_prompt="", prefix_cache=True, device=gpu_or_cpu):
+    """
+    Load a model and fit it on the labels (and examples, if any)
+
+    :param str model_type:  `text2text` or `textgen`
+    :param str model_name:  Model name
+    :param dict labels:  Label -> list of examples
+    :param str main_prompt:  Prompt; the stormtrooper default is used if empty
+    :param bool prefix_cache:  For `textgen` models, encode the shared prompt prefix only once (see
+    `PrefixCachedGenerator`)
+    :param str device:  Device to load the model on
+    :return BatchedGenerator:  Generator wrapping the fitted stormtrooper classifier
+    """
+    have_examples = any(labels.values())
+    if have_examples:
+        # fit() expects a list of examples as the first arg, and a list of
+        # corresponding labels as the second arg
+        examples = itertools.chain(*[v for v in labels.values()])
+        chained_labels = itertools.chain(*[[l] * len(labels[l]) for l in labels.keys()])
+        predictor = {"text2text": Text2TextFewShotClassifier, "textgen": GenerativeFewShotClassifier}[model_type](
+            model_name=model_name, device=device, progress_bar=False, **({"prompt": main_prompt} if main_prompt else {}))
+        predictor.fit(examples, chained_labels)
+    else:
+        predictor = {"text2text": Text2TextZeroShotClassifier, "textgen": GenerativeZeroShotClassifier}[model_type](
+            model_name=model_name, device=device, progress_bar=False, **({"prompt": main_prompt} if main_prompt else {}))
+        predictor.fit(None, labels.keys())
+
+    if model_type == "textgen" and prefix_cache:
+        return PrefixCachedGenerator(predictor)
+
+    return BatchedGenerator(predictor)
+
+
+class InlinePool:
+    """
+    Classify windows of texts in the current process
+
+    Has the same interface as `ShardPool`, so the main loop does not need to
+    know whether it is running with one or more workers.
+    """
+    capacity = 0
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.results = collections.deque()
+
+    def submit(self, window_id, texts):
+        self.results.append((window_id, self.batcher.predict(texts) if texts else [], None))
+
+    def get(self):
+        return self.results.popleft()
+
+    def close(self, wait=True):
+        pass
+
+
+def shard_worker(device, threads, predictor_args, token_budget, max_batch_size, tasks, results):
+    """
+    Classify windows of texts in a worker process
+
+    :param str device:  Device to load the model on
+    :param int threads:  Number of CPU threads to use, or 0 to leave this to torch
+    :param tuple predictor_args:  Arguments for `load_predictor`, except the device
+    :param int token_budget:  See `LengthBucketedBatcher`
+    :param int max_batch_size:  See `LengthBucketedBatcher`
+    :param tasks:  Queue of (window ID, texts) tuples, or `None` to stop
+    :param results:  Queue for (window ID, predicted labels, error) tuples
+    """
+    if threads:
+        torch.set_num_threads(threads)
+
+    try:
+        batcher = LengthBucketedBatcher(load_predictor(*predictor_args, device=device), token_budget, max_batch_size)
+    except Exception as e:
+        results.put((None, None, f"Could not load model on {device}: {e}"))
+        return
+
+    while (task := tasks.get()) is not None:
+        window_id, texts = task
+        try:
+            predicted_labels = batcher.predict(texts) if texts else []
+            results.put((window_id, None if predicted_labels is None else list(predicted_labels), None))
+        except Exception as e:
+            results.put((window_id, None, f"{type(e).__name__}: {e}"))
+
+
+class ShardPool:
+    """
+    Classify windows of texts in parallel worker processes
+
+    Each worker loads its own copy of the model: on its own GPU if several
+    are available (workers are spread over the GPUs otherwise), or on the CPU
+    with an equal share of the CPU cores. Windows are handed out to whichever
+    worker is free; results come back in completion order.
+    """
+    def __init__(self, num_workers, predictor_args, token_budget, max_batch_size):
+        # CUDA cannot be used in forked processes
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.capacity = num_workers * 2
+
+        num_gpus = torch.cuda.device_count() if have_cuda else 0
+        threads = 0 if num_gpus else max(1, (os.cpu_count() or 1) // num_workers)
+        self.processes = []
+        for worker in range(num_workers):
+            device = f"cuda:{worker % num_gpus}" if num_gpus else "cpu"
+            process = context.Process(target=shard_worker, args=(device, threads, predictor_args, token_budget,
+                                                                 max_batch_size, self.tasks, self.results), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def submit(self, window_id, texts):
+        self.tasks.put((window_id, texts))
+
+    def get(self):
+        while True:
+            try:
+                return self.results.get(timeout=5)
+            except queue.Empty:
+                # a worker that stopped (e.g. killed for using too much memory) takes the windows it was working on
+                # with it, so the other workers' results can never be written in order
+                for process in self.processes:
+                    if not process.is_alive():
+                        return None, None, f"Worker process {process.pid} stopped unexpectedly (exit code {process.exitcode}). Saving results so far and halting."
+
+    def close(self, wait=True):
+        """
+        Stop the workers
+
+        :param bool wait:  Let the workers finish the windows they were given first; if not, they are terminated
+        """
+        for process in self.processes:
+            if process.is_alive():
+                self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=60 if wait else 0)
+            if process.is_alive():
+                process.terminate()
+
+
+def main(argv=None, models=None):
+    """
+    Run stormtrooper with the given command line arguments
+
+    :param list argv:  Command line arguments; `sys.argv` if `None`
+    :param models:  `dmi_worker.ModelCache` to keep models loaded between runs, when running as a worker
+    """
     cli = argparse.ArgumentParser()
     cli.add_argument("--model", "-m", help="Model ID: HuggingFace ID or `openai/model_id` for OpenAI models",
                      required=True)
@@ -55,19 +694,37 @@ if __name__ == "__main__":
                      required=True)
     cli.add_argument("--output-dir", "-o", help="Output directory where image will be saved", default="data",
                      required=True)
+    cli.add_argument("--token-budget", "-t", help="Maximum number of (padded) prompt tokens, including instructions and examples, to classify at once; items are grouped by length to fit this (default 8192)",
+                     type=int, default=8192)
+    cli.add_argument("--max-batch-size", "-b", help="Maximum number of items to classify at once (default 100)", type=int, default=100)
+    cli.add_argument("--window", "-w", help="Number of input lines to read ahead and group by length (default 1000)", type=int, default=1000)
+    cli.add_argument("--workers", help="Number of worker processes, each with its own copy of the model, to classify in parallel; spread over the available GPUs, or over the CPU cores (default 1)",
+                     type=int, default=1)
+    cli.add_argument("--no-prefix-cache", help="For textgen models, encode the full prompt for every item instead of re-using the encoded instructions and examples",
+                     action="store_true")
+    cli.add_argument("--cache-file", help="SQLite file to cache predictions in, so texts classified before with the same model, prompt and labels are not classified again",
+                     default=os.path.expanduser("~/.cache/dmi_stormtrooper.sqlite"))
+    cli.add_argument("--no-cache", help="Do not read or write the prediction cache (identical texts are still only classified once per run)",
+                     action="store_true", default=False)
+    cli.add_argument("--output-format", "-f", help="Save results as a single JSON object (results.json, default) or as NDJSON (results.ndjson)",
+                     choices=("json", "ndjson"), default="json")
+    cli.add_argument("--profile", help="Time each processing stage and write a summary to results-profile.json in the output directory (or set DMI_PROFILE=1)",
+                     action="store_true", default=False)
     # These arguments are added by the DMI Service Manager in order for the service to, if desired, provide status updates which will be logged in the DMI Service Manager database.
     cli.add_argument("--database_key", "-k", default="",
                      help="DMI Service Manager database key to provide status updates.")
     cli.add_argument("--dmi_sm_server", "-s", default="",
                      help="DMI Service Manager server address to provide status updates.")
 
-    args = cli.parse_args()
+    args = cli.parse_args(argv)
+    status = StatusReporter(args.dmi_sm_server, args.database_key)
+    load = models.get if models is not None else lambda key, loader: loader()
 
     model_map = {}
     with open("local-models.yml") as infile:
         available_models = yaml.full_load(infile)
-        for model_type, models in available_models.items():
-            model_map.update({model: model_type for model in models})
+        for model_type, type_models in available_models.items():
+            model_map.update({model: model_type for model in type_models})
 
     if args.model not in model_map:
         print(f"Model {args.model} is not available or enabled.", file=sys.stderr)
@@ -77,10 +734,9 @@ if __name__ == "__main__":
 
     labelpath = Path(args.labelfile)
     inputpath = Path(args.inputfile)
-    outputpath = Path(args.output_dir).joinpath("results.json")
+    outputpath = Path(args.output_dir).joinpath(f"results.{args.output_format}")
 
-    if args.prompt:
-        main_prompt = args.prompt
+    main_prompt = args.prompt
 
     if not labelpath.exists():
         print(f"Label file not available at {labelpath}.", file=sys.stderr)
@@ -99,20 +755,7 @@ if __name__ == "__main__":
             exit(1)
 
     if model_type in ("text2text", "textgen"):
-        have_examples = any(labels.values())
         model_name = args.model.split("/").pop()  # if pre-loaded, the models are stored in folders of this name
-        if have_examples:
-            # fit() expects a list of examples as the first arg, and a list of
-            # corresponding labels as the second arg
-            examples = itertools.chain(*[v for v in labels.values()])
-            chained_labels = itertools.chain(*[[l] * len(labels[l]) for l in labels.keys()])
-            predictor = {"text2text": Text2TextFewShotClassifier, "textgen": GenerativeFewShotClassifier}[model_type](
-                model_name=model_name, device=gpu_or_cpu, progress_bar=False, **({"prompt": main_prompt} if main_prompt else {}))
-            predictor.fit(examples, chained_labels)
-        else:
-            predictor = {"text2text": Text2TextZeroShotClassifier, "textgen": GenerativeZeroShotClassifier}[model_type](
-                model_name=model_name, device=gpu_or_cpu, progress_bar=False, **({"prompt": main_prompt} if main_prompt else {}))
-            predictor.fit(None, labels.keys())
 
         # we *could* just load all data into a list and pass it to the predictor in
         # its entirety
@@ -120,65 +763,102 @@ if __name__ == "__main__":
         # so instead work in batches, and also write the result in batches, so that
         # we don't use a theoretically infinite amount of memory
 
-        batch_size = 100
-        input_exhausted = False
-        looping = True
-        batch = {}
-
-        # clear output file
-        with outputpath.open("w") as outfile:
-            pass
-
-        # loop through items to label
-        line = 0
-        num_items = count_lines(inputpath)
-        with inputpath.open() as infile:
-            while looping:
-                if len(batch) >= batch_size or input_exhausted:
-                    predicted_labels = predictor.predict(batch.values())
-
-                    if (predicted_labels is None):
-                        print(
-                            f"Got no predictions for batch. Saving results so far and halting. Batch was {batch}.",
-                            file=sys.stderr)
-                        input_exhausted = True
-                    else:
-                        # make list from numpy array
-                        predicted_labels = list(predicted_labels)
-
-                        for item_id in batch.keys():
-                            with outputpath.open("a") as outfile:
-                                written_bytes = outputpath.stat().st_size
-                                if written_bytes == 0:
-                                    outfile.write("{\n")
-                                    outfile.flush()
-                                elif written_bytes > 2:
-                                    outfile.write(",\n")
-                                outfile.write(f"  {json.dumps(item_id)}: {json.dumps(predicted_labels.pop(0))}")
-
-                    batch = {}
-                    if input_exhausted:
-                        with outputpath.open("a") as outfile:
-                            outfile.write("\n}")
-                        looping = False
-
-                try:
-                    line += 1
-                    try:
-                        item = json.loads(next(infile).strip())
-                        batch.update(
-                            item)  # theoretically, could be any number of items per line (but one is recommended)
-                    except json.JSONDecodeError:
-                        print(
-                            f"Error parsing line {line:,} from {inputpath} as JSON. Saving results so far and halting.",
-                            file=sys.stderr)
-                        input_exhausted = True
+        # items are read in windows, which are then split into batches of
+        # similar length; results are written in input order per window
+        if args.workers > 1:
+            pool = ShardPool(args.workers, (model_type, model_name, labels, main_prompt, not args.no_prefix_cache),
+                             args.token_budget, args.max_batch_size)
+        else:
+            # the fitted classifier depends on the labels and examples, so these are part of the key
+            predictor = load(("stormtrooper", model_type, model_name, main_prompt, json.dumps(labels, sort_keys=True),
+                              not args.no_prefix_cache),
+                             lambda: load_predictor(model_type, model_name, labels, main_prompt, not args.no_prefix_cache))
+            pool = InlinePool(LengthBucketedBatcher(predictor, args.token_budget, args.max_batch_size))
+
+        writer = ResultWriter(outputpath, args.output_format)
+        cache = PredictionCache({"model": args.model, "prompt": main_prompt, "labels": labels},
+                                None if args.no_cache else args.cache_file)
+
+        # windows that have been submitted for classification, but not written yet, and their results; windows may
+        # complete out of order when there are several workers, but are written in order
+        windows = {}
+        completed = {}
+        next_window = 0
+        processed = 0
+        halted = False
+
+        def collect():
+            """
+            Wait for a window to be classified, and write all windows that are ready
+            """
+            nonlocal next_window, processed, halted
+            with stage("model"):
+                window_id, predicted_labels, error = pool.get()
+            if predicted_labels is None:
+                print(error or f"Got no predictions for window {window_id:,}. Saving results so far and halting.", file=sys.stderr)
+                halted = True
+                return
+
+            completed[window_id] = predicted_labels
+            while next_window in completed:
+                item_ids, hashes, known, todo, bytes_read = windows.pop(next_window)
+                predicted_labels = dict(zip(todo, completed.pop(next_window)))
+                with stage("cache"):
+                    cache.put_many(predicted_labels)
+                known.update(predicted_labels)
+
+                with stage("write", items=len(item_ids)):
+                    writer.write_batch(zip(item_ids, [known[digest] for digest in hashes]))
+                processed += len(item_ids)
+                next_window += 1
 
-                except StopIteration:
-                    input_exhausted = True
+                with stage("status"):
+                    status.log(annotate(f"Processed {processed:,} items ({bytes_read / input_size if input_size else 1:.0%} of input)"),
+                               num_records=processed)
 
-                log(f"Processed {line:,} of {num_items:,} items", args.dmi_sm_server, args.database_key, num_records=line)
+        # progress is based on how much of the file has been read, so the file
+        # does not need to be read an extra time just to count the items
+        input_size = inputpath.stat().st_size
+        profiler = Profiler(args.profile)
+        for window_id, (batch, lines_read, bytes_read, error) in enumerate(timed("read", read_batches(inputpath, max(1, args.window)),
+                                                                                 lambda window: len(window[0]))):
+            # only classify texts that have not been classified before, and identical texts only once
+            with stage("cache", items=len(batch)):
+                hashes = [text_hash(text) for text in batch.values()]
+                known = cache.get_many(set(hashes))
+                todo = {}
+                for digest, text in zip(hashes, batch.values()):
+                    if digest not in known and digest not in todo:
+                        todo[digest] = text
+
+            windows[window_id] = (list(batch.keys()), hashes, known, list(todo.keys()), bytes_read)
+            # with a single worker, classification happens here; with several, while waiting for results in collect()
+            with stage("model", items=len(todo), sync=True):
+                pool.submit(window_id, list(todo.values()))
+
+            while windows and len(windows) > pool.capacity and not halted:
+                collect()
+
+            if error:
+                print(error, file=sys.stderr)
+                break
+
+            if halted:
+                break
+
+        while windows and not halted:
+            collect()
+
+        # after an error, results of windows still being classified could not be written anyway
+        pool.close(wait=not halted)
+        writer.close()
+        cache.close()
+        profiler.finish(Path(args.output_dir).joinpath("results-profile.json"), status)
 
     else:
         print(f"OpenAI models are currently not supported.", file=sys.stderr)
         exit(1)
+
+
+if __name__ == "__main__":
+    main()